@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+
+class Admission:
+    """Limit on concurrent sessions with a short FIFO wait queue.
+
+    max_sessions == 0 disables the limit. A freed slot is handed directly to
+    the oldest waiter. Must be used from the event loop thread.
+    """
+
+    def __init__(self, max_sessions=0, max_waiting=0, wait_timeout=5.0):
+        self.max_sessions = max_sessions
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self.waiters = collections.deque()
+        self.rejected = 0
+
+    def full(self):
+        """True when a new connection could neither start nor wait."""
+        return (self.max_sessions > 0 and self.active >= self.max_sessions
+                and len(self.waiters) >= self.max_waiting)
+
+    def try_acquire(self):
+        """Take a slot only if one is free right now, never wait."""
+        if not self.max_sessions or (self.active < self.max_sessions and not self.waiters):
+            self.active += 1
+            return True
+        self.rejected += 1
+        return False
+
+    async def acquire(self):
+        if not self.max_sessions or (self.active < self.max_sessions and not self.waiters):
+            self.active += 1
+            return True
+        if len(self.waiters) >= self.max_waiting:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.wait_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        except asyncio.CancelledError:
+            # Pass on a slot that was handed over just before the cancel
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+from model_registry import load_model
+from model_registry import model_key
+from recognizer_pool import new_recognizer
+
+model = None
+
+def wav_data(f):
+    """Memory map a WAV file, return (mmap, sample rate, PCM data view).
+
+    Only 16-bit mono PCM is accepted, which is what the microphone clients
+    record and what the recognizer takes without conversion.
+    """
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[0:4] != b'RIFF' or mm[8:12] != b'WAVE':
+        mm.close()
+        raise ValueError('not a WAV file')
+    pos = 12
+    rate = None
+    while pos + 8 <= len(mm):
+        chunk, size = struct.unpack_from('<4sI', mm, pos)
+        pos += 8
+        if chunk == b'fmt ':
+            fmt, channels, rate, _, _, bits = struct.unpack_from('<HHIIHH', mm, pos)
+            if fmt != 1 or channels != 1 or bits != 16:
+                mm.close()
+                raise ValueError('only 16-bit mono PCM is supported')
+        elif chunk == b'data':
+            if rate is None:
+                break
+            size = min(size, len(mm) - pos)
+            return mm, rate, memoryview(mm)[pos:pos + size]
+        pos += size + (size & 1)
+    mm.close()
+    raise ValueError('no fmt or data chunk')
+
+def init_worker(key):
+    global model
+    model = load_model(key)
+
+def transcribe(path, show_words, block_seconds):
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        mm, rate, data = wav_data(f)
+        try:
+            rec = new_recognizer(model, rate, show_words=show_words)
+            block = int(rate * block_seconds) * 2
+            results = []
+            for offset in range(0, len(data), block):
+                if rec.AcceptWaveform(bytes(data[offset:offset + block])):
+                    results.append(json.loads(rec.Result()))
+            results.append(json.loads(rec.FinalResult()))
+            duration = len(data) / (2.0 * rate)
+        finally:
+            data.release()
+            mm.close()
+    elapsed = time.perf_counter() - started
+    return {
+        'path': path,
+        'text': ' '.join(r['text'] for r in results if r.get('text')),
+        'result': results,
+        'duration': round(duration, 3),
+        'elapsed': round(elapsed, 3),
+        'rtf': round(elapsed / duration, 4) if duration else None,
+    }
+
+def find_wavs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.wav'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def finished(output):
+    """Paths already transcribed without error by an earlier run."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' not in record:
+                done.add(record['path'])
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch transcription of WAV files")
+    parser.add_argument('paths', nargs='+', help='WAV files or directories')
+    parser.add_argument('-o', '--output', default='transcripts.jsonl', help='JSONL output, appended to')
+    parser.add_argument('-m', '--model', default=os.environ.get('VOSK_MODEL_KEY', 'lang:ja'),
+                        help='model path or lang:<code>')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('-b', '--block-seconds', type=float, default=0.5, help='audio per AcceptWaveform call')
+    parser.add_argument('--no-words', dest='words', action='store_false', help='omit word timings')
+    parser.add_argument('--no-fork', dest='fork', action='store_false',
+                        help='load the model in every worker instead of sharing it by fork')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    done = finished(args.output)
+    paths = [os.path.abspath(p) for p in find_wavs(args.paths)]
+    todo = [p for p in paths if p not in done]
+    logging.info('%d files, %d already done, %d to transcribe', len(paths), len(paths) - len(todo), len(todo))
+    if not todo:
+        return
+
+    # With fork the model is loaded once here and its pages are shared by
+    # all workers, otherwise every worker loads its own copy
+    key = model_key(args.model)
+    if args.fork and 'fork' in multiprocessing.get_all_start_methods():
+        init_worker(key)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.jobs, mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            args.jobs, initializer=init_worker, initargs=(key,))
+
+    audio = 0.0
+    started = time.perf_counter()
+    with executor, open(args.output, 'a', encoding='utf-8') as out:
+        futures = {executor.submit(transcribe, p, args.words, args.block_seconds): p for p in todo}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                record = future.result()
+                audio += record['duration']
+                logging.info('%s: %.1f s, rtf %s', path, record['duration'], record['rtf'])
+            except Exception as e:
+                logging.error('%s: %s', path, e)
+                record = {'path': path, 'error': str(e)}
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+    elapsed = time.perf_counter() - started
+    logging.info('Transcribed %.1f s of audio in %.1f s', audio, elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import time
+import urllib.request
+import wave
+import websockets
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[int(round(q * (len(values) - 1)))]
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 4),
+        'p50': round(pick(0.50), 4),
+        'p95': round(pick(0.95), 4),
+        'p99': round(pick(0.99), 4),
+        'max': round(values[-1], 4),
+    }
+
+def read_wav(path):
+    with wave.open(path, 'rb') as wf:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != 'NONE':
+            raise ValueError('%s: only 16-bit mono PCM is supported' % path)
+        return wf.getframerate(), wf.readframes(wf.getnframes())
+
+def scrape(uri):
+    """Decode and audio totals from the server's /metrics, None if unavailable."""
+    url = re.sub(r'^ws', 'http', uri).rstrip('/') + '/metrics'
+    try:
+        with urllib.request.urlopen(url, timeout=5) as r:
+            text = r.read().decode('utf-8')
+    except Exception as e:
+        logging.warning('Cannot read %s: %s', url, e)
+        return None
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+async def session(index, audio, args, stats):
+    rate, data = audio
+    chunk = int(rate * args.chunk_ms / 1000) * 2
+    duration = args.chunk_ms / 1000.0
+    await asyncio.sleep(args.ramp * index / max(1, args.sessions))
+
+    async with websockets.connect(args.uri) as websocket:
+        await websocket.send(json.dumps({"config": {"sample_rate": rate}}))
+        start = time.monotonic()
+        first_partial = None
+        for i, offset in enumerate(range(0, len(data), chunk)):
+            if args.speed > 0:
+                delay = start + i * duration / args.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent = time.monotonic()
+            await websocket.send(data[offset:offset + chunk])
+            response = json.loads(await websocket.recv())
+            now = time.monotonic()
+            stats['rtt'].append(now - sent)
+            if first_partial is None and (response.get('partial') or response.get('text')):
+                first_partial = now - start
+            if 'text' in response:
+                stats['results'] += 1
+
+        ended = time.monotonic()
+        await websocket.send('{"eof" : 1}')
+        json.loads(await websocket.recv())
+        stats['final_latency'].append(time.monotonic() - ended)
+        if first_partial is not None:
+            stats['first_partial'].append(first_partial)
+        stats['audio'] += len(data) / (2.0 * rate)
+
+async def run(args):
+    audio = [read_wav(path) for path in args.wavs]
+    stats = {'rtt': [], 'first_partial': [], 'final_latency': [], 'results': 0, 'audio': 0.0, 'errors': 0}
+
+    async def guarded(index):
+        try:
+            await session(index, audio[index % len(audio)], args, stats)
+        except Exception as e:
+            logging.error('Session %d: %s', index, e)
+            stats['errors'] += 1
+
+    before = scrape(args.uri)
+    started = time.monotonic()
+    await asyncio.gather(*(guarded(i) for i in range(args.sessions)))
+    elapsed = time.monotonic() - started
+    after = scrape(args.uri)
+
+    server_rtf = None
+    if before and after:
+        decode = after.get('vosk_decode_seconds_sum', 0) - before.get('vosk_decode_seconds_sum', 0)
+        decoded = after.get('vosk_audio_seconds_total', 0) - before.get('vosk_audio_seconds_total', 0)
+        if decoded:
+            server_rtf = round(decode / decoded, 4)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': commit,
+        'host': platform.node(),
+        'cpus': os.cpu_count(),
+        'uri': args.uri,
+        'sessions': args.sessions,
+        'speed': args.speed,
+        'chunk_ms': args.chunk_ms,
+        'files': args.wavs,
+        'elapsed': round(elapsed, 3),
+        'audio_seconds': round(stats['audio'], 3),
+        'errors': stats['errors'],
+        'results': stats['results'],
+        'time_to_first_partial': percentiles(stats['first_partial']),
+        'final_latency': percentiles(stats['final_latency']),
+        'chunk_rtt': percentiles(stats['rtt']),
+        'server_rtf': server_rtf,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for asr_server.py")
+    parser.add_argument('wavs', nargs='+', help='16-bit mono WAV files, replayed round robin')
+    parser.add_argument('-u', '--uri', default='ws://localhost:2700', help='Server URL')
+    parser.add_argument('-n', '--sessions', type=int, default=8, help='concurrent connections')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='replay speed, 1 = real time, 0 = as fast as possible')
+    parser.add_argument('-c', '--chunk-ms', type=int, default=250, help='audio per message')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which sessions are started')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
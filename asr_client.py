@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+import time
+
+class AudioQueue(asyncio.Queue):
+    """Bounded queue of microphone blocks for the ASR sender.
+
+    The sound device callback must never wait, so when the sender falls
+    behind by maxsize blocks the oldest block is dropped and counted. A
+    warning is logged as soon as dropping starts, and check_dropped() tells
+    the client after a result whether the utterance lost audio. Every block
+    remembers when it was queued, the sender reports how long it waited as
+    the queue lag.
+    """
+
+    def __init__(self, maxsize=40):
+        super().__init__(maxsize)
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.checked = 0
+        self.overflowing = False
+        self.lag = 0.0
+        self.max_lag = 0.0
+
+    def put_nowait(self, data):
+        if self.full():
+            old, _ = super().get_nowait()
+            self.dropped += 1
+            self.dropped_bytes += len(old)
+            if not self.overflowing:
+                self.overflowing = True
+                logging.warning('ASR audio queue full (%d blocks), dropping audio until the sender catches up',
+                                self.maxsize)
+        super().put_nowait((data, time.monotonic()))
+
+    async def get_block(self):
+        data, queued = await self.get()
+        self.lag = time.monotonic() - queued
+        self.max_lag = max(self.max_lag, self.lag)
+        if self.overflowing and self.qsize() <= self.maxsize // 2:
+            self.overflowing = False
+        return data
+
+    def check_dropped(self):
+        """Warn about blocks dropped since the last check, return their number."""
+        blocks = self.dropped - self.checked
+        if blocks:
+            logging.warning('%d audio blocks were dropped before this result, it may be missing words '
+                            '(%d blocks, %d bytes dropped in total)', blocks, self.dropped, self.dropped_bytes)
+        self.checked = self.dropped
+        return blocks
+
+async def send_audio(websocket, audio_queue, report_seconds=10.0):
+    """Send audio blocks as soon as they are queued, without waiting for results."""
+    reported = time.monotonic()
+    while True:
+        data = await audio_queue.get_block()
+        await websocket.send(data)
+        now = time.monotonic()
+        if report_seconds and now - reported >= report_seconds:
+            logging.info('ASR audio queue: %d blocks, lag %.0f ms (max %.0f ms), %d dropped',
+                         audio_queue.qsize(), audio_queue.lag * 1000, audio_queue.max_lag * 1000,
+                         audio_queue.dropped)
+            audio_queue.max_lag = 0.0
+            reported = now
+
+async def stream_audio(websocket, audio_queue, handle_result):
+    """Run the ASR connection full duplex.
+
+    A sender task streams the queued audio while the results are read here
+    and passed to handle_result(result_json), which may take as long as it
+    likes (LLM, TTS) without holding back the audio. Returns when
+    handle_result returns True or the connection closes.
+    """
+    sender = asyncio.ensure_future(send_audio(websocket, audio_queue))
+    try:
+        async for message in websocket:
+            if await handle_result(json.loads(message)):
+                break
+            if sender.done():
+                sender.result()
+    finally:
+        sender.cancel()
+
+async def finish(websocket):
+    """Send eof and return the final result, the last message before the server closes."""
+    await websocket.send('{"eof" : 1}')
+    final_result = None
+    async for message in websocket:
+        final_result = message
+    return final_result
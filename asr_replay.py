@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+import websockets
+from audio_tap import read_records
+from audio_tap import session_segments
+from audio_tap import BINARY, HEADER, TEXT
+
+def list_sessions(directory):
+    sessions = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.tap'):
+            session_id = name.split('.', 1)[0]
+            sessions.setdefault(session_id, []).append(os.path.join(directory, name))
+    for session_id, paths in sessions.items():
+        header = {}
+        for seconds, kind, payload in read_records(paths[0]):
+            if kind == HEADER:
+                header = json.loads(payload)
+            break
+        started = header.get('started')
+        print('%s  %s  %s  %.2f MB' % (
+            session_id,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)) if started else '?',
+            header.get('remote', '?'),
+            sum(os.path.getsize(p) for p in paths) / (1024 * 1024)))
+
+async def replay(args):
+    paths = session_segments(args.directory, args.session)
+    if not paths:
+        raise SystemExit('No recording of session %s in %s' % (args.session, args.directory))
+
+    # A multiplexed session is replayed on the same path
+    uri = args.uri
+    for seconds, kind, payload in read_records(paths[0]):
+        path = json.loads(payload).get('path', '/') if kind == HEADER else '/'
+        if path != '/':
+            uri = uri.rstrip('/') + path
+        break
+
+    async with websockets.connect(uri) as websocket:
+
+        async def receive():
+            async for response in websocket:
+                print(response)
+
+        receiver = asyncio.ensure_future(receive())
+        start = time.monotonic()
+        for path in paths:
+            for seconds, kind, payload in read_records(path):
+                if kind not in (TEXT, BINARY):
+                    continue
+                if args.speed > 0:
+                    delay = start + seconds / args.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await websocket.send(payload.decode('utf-8') if kind == TEXT else payload)
+        # Give the last responses time to arrive, the recording ends where
+        # the client stopped sending
+        await asyncio.sleep(args.linger)
+        await websocket.close()
+        await receiver
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a session recorded by asr_server.py VOSK_TAP_DIR")
+    parser.add_argument('directory', help='VOSK_TAP_DIR of the server that recorded it')
+    parser.add_argument('session', nargs='?', help='session id, list the recorded sessions if omitted')
+    parser.add_argument('-u', '--uri', default='ws://localhost:2700', help='Server URL')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='replay speed, 1 = original timing, 0 = as fast as possible')
+    parser.add_argument('--linger', type=float, default=2.0, help='seconds to wait for responses at the end')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.session:
+        asyncio.run(replay(args))
+    else:
+        list_sessions(args.directory)
+
+if __name__ == '__main__':
+    main()
@@ -8,88 +8,629 @@ import pathlib
 import websockets
 import concurrent.futures
 import logging
-from vosk import Model, SpkModel, KaldiRecognizer
+import signal
+import time
+import gc
+import http
+import random
+import struct
+from vosk import SpkModel
+from model_registry import ModelRegistry
+from model_registry import model_key
+from model_registry import load_model
+from recognizer_pool import RecognizerPool
+from recognizer_pool import check_endpointer
+from grammars import GrammarCache
+from speaker import extract_xvector
+from speaker import RunningMean
+from audio_buffer import AudioRebuffer
+from admission import Admission
+from metrics import Metrics
+from audio_tap import AudioTap
+from audio_tap import BINARY, TEXT
+try:
+    from resampler import StreamResampler
+    from speaker_store import SpeakerStore
+except ImportError:
+    StreamResampler = None
+    SpeakerStore = None
 
-def process_chunk(rec, message):
-    if message == b'{"eof" : 1}':
-        return rec.FinalResult(), True
-    if message == b'{"reset" : 1}':
-        return rec.FinalResult(), False
-    elif rec.AcceptWaveform(message):
-        return rec.Result(), False
+EOF = b'{"eof" : 1}'
+RESET = b'{"reset" : 1}'
+EMPTY_PARTIAL = '{\n  "partial" : ""\n}'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+metrics = Metrics()
+metrics.gauge('vosk_sessions', 'Active sessions', lambda: admission.active)
+metrics.gauge('vosk_sessions_waiting', 'Connections waiting for a session slot', lambda: len(admission.waiters))
+metrics.counter('vosk_sessions_rejected_total', 'Connections refused by admission control', lambda: admission.rejected)
+DEGRADED = metrics.gauge('vosk_sessions_degraded', 'Sessions behind real time with partial results disabled')
+metrics.gauge('vosk_executor_queue_depth', 'Decode jobs waiting for a thread', lambda: pool._work_queue.qsize())
+QUEUE_WAIT = metrics.histogram('vosk_queue_wait_seconds', 'Time decode jobs waited for a thread', LATENCY_BUCKETS)
+DECODE_TIME = metrics.histogram('vosk_decode_seconds', 'Time spent in AcceptWaveform and result calls', LATENCY_BUCKETS)
+SESSION_RTF = metrics.histogram('vosk_session_rtf', 'Decode time divided by audio time per session', RTF_BUCKETS)
+AUDIO_BYTES = metrics.counter('vosk_audio_bytes_total', 'Audio bytes received')
+AUDIO_SECONDS = metrics.counter('vosk_audio_seconds_total', 'Seconds of audio decoded')
+PARTIALS = metrics.counter('vosk_partial_results_total', 'Partial results computed')
+FINALS = metrics.counter('vosk_final_results_total', 'Final results computed')
+ENDPOINT_LATENCY = metrics.histogram('vosk_endpoint_latency_seconds',
+                                     'Audio between the last change of the partial result and the final result',
+                                     (0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0))
+SPK_SKIPPED = metrics.counter('vosk_speaker_skipped_total',
+                              'Utterances without a speaker vector because the previous one was still computed')
+metrics.counter('vosk_recognizer_pool_hits_total', 'Recognizers reused from the pool', lambda: recognizers.hits)
+metrics.counter('vosk_recognizer_pool_misses_total', 'Recognizers built because none was idle', lambda: recognizers.misses)
+metrics.counter('vosk_grammar_cache_hits_total', 'Phrase lists found in the grammar cache', lambda: grammars.hits)
+metrics.counter('vosk_tap_dropped_total', 'Records the audio tap dropped because its queue was full',
+                lambda: tap.dropped if tap else 0)
+
+def endpointer_config(conf):
+    """Endpointer settings from config, a mode name and/or trailing silence delays.
+
+    Raises ValueError for settings the recognizer could not apply.
+    """
+    if not conf:
+        return None
+    if isinstance(conf, str):
+        endpointer = conf, None
+    elif isinstance(conf, dict):
+        delays = None
+        if any(k in conf for k in ('start_max', 'end', 'max')):
+            try:
+                delays = (float(conf.get('start_max', 5.0)), float(conf.get('end', 0.5)),
+                          float(conf.get('max', 20.0)))
+            except (TypeError, ValueError):
+                raise ValueError('Endpointer delays must be numbers')
+        endpointer = conf.get('mode'), delays
     else:
-        return rec.PartialResult(), False
+        raise ValueError('Endpointer config must be a mode name or an object')
+    check_endpointer(endpointer)
+    return endpointer
 
-async def recognize(websocket, path):
-    global model
-    global spk_model
-    global args
-    global pool
+def timed(submitted, func, *args):
+    """Run func on a worker thread, return (result, queue wait, run time)."""
+    started = time.monotonic()
+    result = func(*args)
+    return result, started - submitted, time.monotonic() - started
 
-    loop = asyncio.get_running_loop()
-    rec = None
-    phrase_list = None
-    sample_rate = args.sample_rate
-    show_words = args.show_words
-    max_alternatives = args.max_alternatives
+def process_chunk(rec, message, tail=None, partial=True):
+    """Decode one block, return (response, final, stop).
 
-    logging.info('Connection from %s', websocket.remote_address);
+    With partial=False no partial result is computed and response is None.
+    """
+    if tail and message in (EOF, RESET) and rec.AcceptWaveform(tail):
+        return rec.Result(), True, message == EOF
+    if message == EOF:
+        return rec.FinalResult(), True, True
+    if message == RESET:
+        return rec.FinalResult(), True, False
+    elif rec.AcceptWaveform(message):
+        return rec.Result(), True, False
+    elif partial:
+        return rec.PartialResult(), False, False
+    else:
+        return None, False, False
 
-    while True:
-
-        message = await websocket.recv()
-
-        # Load configuration if provided
-        if isinstance(message, str) and 'config' in message:
-            jobj = json.loads(message)['config']
-            logging.info("Config %s", jobj)
-            if 'phrase_list' in jobj:
-                phrase_list = jobj['phrase_list']
-            if 'sample_rate' in jobj:
-                sample_rate = float(jobj['sample_rate'])
-            if 'model' in jobj:
-                model = Model(jobj['model'])
-                model_changed = True
-            if 'words' in jobj:
-                show_words = bool(jobj['words'])
-            if 'max_alternatives' in jobj:
-                max_alternatives = int(jobj['max_alternatives'])
-            continue
+class Session:
+    """Recognition state of one client connection."""
 
-        # Create the recognizer, word list is temporary disabled since not every model supports it
-        if not rec or model_changed:
-            model_changed = False
-            if phrase_list:
-                rec = KaldiRecognizer(model, sample_rate, json.dumps(phrase_list, ensure_ascii=False))
+    def __init__(self, loop, send):
+        self.loop = loop
+        self.send = send
+        self.entry = None
+        self.rec = None
+        self.rec_key = None
+        self.grammar = None
+        self.endpointer = args.endpointer
+        self.voiced_at = None
+        self.sample_rate = args.sample_rate
+        self.show_words = args.show_words
+        self.max_alternatives = args.max_alternatives
+        self.format = 'int16'
+        self.resampler = None
+        self.resample_cost = 0.0
+        self.resample_seconds = 0.0
+        self.chunk_ms = args.chunk_ms
+        self.buffer = None
+        self.last_partial = EMPTY_PARTIAL
+        self.partials = 'all'
+        self.partial_interval = 0.0
+        self.sent_partial = EMPTY_PARTIAL
+        self.sent_at = 0.0
+        self.rate = args.model_rate
+        self.lag = 0.0
+        self.degraded = False
+        self.audio_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.utterance = bytearray()
+        self.utterances = 0
+        self.speaker = RunningMean()
+        self.followups = set()
+        self.messages = 0
+        self.decodes = 0
+
+    async def open(self):
+        # Sessions hold a reference to the model they decode with, a config switch
+        # only affects this connection and is a dict lookup once the model is loaded
+        self.entry = await registry.acquire(args.model_key)
+
+    async def configure(self, jobj):
+        logging.info("Config %s", jobj)
+        await self.release_recognizer()
+        if 'phrase_list' in jobj:
+            self.grammar = grammars.canonical(jobj['phrase_list'])
+        if 'grammar' in jobj:
+            try:
+                self.grammar = grammars.lookup(jobj['grammar']) if jobj['grammar'] else None
+            except ValueError as e:
+                # The session goes on with its previous grammar
+                await self.reject(str(e))
+        if 'sample_rate' in jobj:
+            self.sample_rate = float(jobj['sample_rate'])
+        if 'format' in jobj:
+            if jobj['format'] not in ('int16', 'float32'):
+                await self.reject('Unsupported sample format %s' % jobj['format'])
+            elif jobj['format'] != 'int16' and not StreamResampler:
+                await self.reject('numpy is required for %s audio' % jobj['format'])
             else:
-                rec = KaldiRecognizer(model, sample_rate)
-            rec.SetWords(show_words)
-            rec.SetMaxAlternatives(max_alternatives)
-            if spk_model:
-                rec.SetSpkModel(spk_model)
+                self.format = jobj['format']
+        if 'model' in jobj:
+            entry = await registry.acquire(model_key(jobj['model']))
+            registry.release(self.entry)
+            self.entry = entry
+        if 'endpointer' in jobj:
+            try:
+                self.endpointer = endpointer_config(jobj['endpointer'])
+            except ValueError as e:
+                await self.reject(str(e))
+        if 'enroll' in jobj or 'unenroll' in jobj:
+            # Clients are not trusted with the store, speakers are enrolled
+            # with speaker_store.py
+            await self.reject('Enrollment is not available to clients')
+        if 'words' in jobj:
+            self.show_words = bool(jobj['words'])
+        if 'max_alternatives' in jobj:
+            self.max_alternatives = int(jobj['max_alternatives'])
+        if 'chunk_ms' in jobj:
+            self.chunk_ms = int(jobj['chunk_ms'])
+        if 'partials' in jobj:
+            self.partials = jobj['partials']
+        if 'partial_interval_ms' in jobj:
+            self.partial_interval = int(jobj['partial_interval_ms']) / 1000.0
+
+    async def reject(self, text):
+        # A config value the session can not use is answered with an error,
+        # the rest of the config still applies
+        logging.warning('Config rejected: %s', text)
+        await self.send(json.dumps({'error': text}))
+
+    async def process(self, message):
+        """Handle one audio or control message, return (response, stop).
+
+        response is None when the client asked not to receive this partial.
+        """
+        self.messages += 1
+        received = time.monotonic()
+
+        if not self.rec:
+            await self.open_recognizer()
 
         if isinstance(message, str):
             message = message.encode('utf-8')
+        else:
+            AUDIO_BYTES.inc(len(message))
 
-        response, stop = await loop.run_in_executor(pool, process_chunk, rec, message)
-        await websocket.send(response)
-        if stop: break
+        # Small messages are collected until a decode sized block is ready,
+        # in between the client gets the last partial result again
+        tail = None
+        if self.resampler and message not in (EOF, RESET):
+            # Resampling is CPU work like decoding, it runs in the same
+            # worker job and the resampled block comes back with the result
+            (message, result), queued, took = await self.loop.run_in_executor(
+                pool, timed, time.monotonic(), self.resample_chunk, message, not self.degraded)
+            if message is None:
+                return self.idle_response(), False
+        else:
+            if message in (EOF, RESET):
+                if self.buffer:
+                    tail = self.buffer.flush()
+            elif self.buffer:
+                message = self.buffer.feed(message)
+                if message is None:
+                    return self.idle_response(), False
+            result, queued, took = await self.loop.run_in_executor(
+                pool, timed, time.monotonic(), process_chunk, self.rec, message, tail, not self.degraded)
 
+        self.decodes += 1
+        response, final, stop = result
+        QUEUE_WAIT.observe(queued)
+        DECODE_TIME.observe(took)
+        self.decode_seconds += took
+        if spk_model:
+            self.utterance += tail or (message if message not in (EOF, RESET) else b'')
+            excess = len(self.utterance) - int(args.spk_max_seconds * self.rate) * 2
+            if excess > 0:
+                del self.utterance[:excess]
+        if message not in (EOF, RESET):
+            audio = len(message) / (2 * self.rate)
+            self.audio_seconds += audio
+            AUDIO_SECONDS.inc(audio)
+            self.track_lag(time.monotonic() - received, audio)
+        if response is None:
+            return self.idle_response(), stop
+        if final:
+            FINALS.inc()
+            if spk_model:
+                self.embed_utterance()
+            if self.voiced_at is not None and message not in (EOF, RESET):
+                self.track_endpoint()
+            self.voiced_at = None
+            self.last_partial = EMPTY_PARTIAL
+            self.sent_partial = EMPTY_PARTIAL
+        else:
+            PARTIALS.inc()
+            if response != self.last_partial:
+                self.voiced_at = self.audio_seconds
+            self.last_partial = response
+            if self.suppress_partial(response):
+                return None, stop
+        return response, stop
 
+    def resample_chunk(self, message, partial):
+        """Resample one audio message and decode it once a block is ready.
 
-async def start():
+        Runs on a worker thread, returns (block, process_chunk result) or
+        (None, None) while the block is still being collected.
+        """
+        message = self.resampler.process(message)
+        if self.buffer:
+            message = self.buffer.feed(message)
+            if message is None:
+                return None, None
+        return message, process_chunk(self.rec, message, None, partial)
+
+    def embed_utterance(self):
+        # Speaker identification runs on its own executor after the text was
+        # sent, the vector follows in a separate message
+        audio = bytes(self.utterance)
+        self.utterance.clear()
+        self.utterances += 1
+        if len(audio) < args.spk_min_seconds * 2 * self.rate:
+            return
+        # The vector costs a second pass of the acoustic model over the
+        # utterance, with one pending per session that pass can not pile up
+        # behind a session that talks faster than the speaker pool keeps up
+        if self.followups:
+            SPK_SKIPPED.inc()
+            return
+        task = asyncio.ensure_future(self.send_speaker(self.entry, self.rate, audio, self.utterances))
+        self.followups.add(task)
+        task.add_done_callback(self.followups.discard)
+
+    async def send_speaker(self, entry, rate, audio, utterance):
+        vector, frames = await self.loop.run_in_executor(
+            spk_pool, extract_xvector, recognizers, entry, rate, audio, spk_model)
+        if not vector:
+            return
+        self.speaker.add(vector, frames)
+        followup = {'spk': vector, 'spk_frames': frames, 'utterance': utterance,
+                    'spk_mean': [round(v, 6) for v in self.speaker.mean], 'spk_mean_frames': self.speaker.frames}
+        if speakers is not None:
+            # The utterance says who spoke just now, the session mean gives a
+            # steadier answer for a single speaker session
+            speakers.refresh()
+            for prefix, v in (('', vector), ('session_', self.speaker.mean)):
+                speaker, score = speakers.identify(v)
+                if speaker is not None and score >= args.spk_threshold:
+                    followup[prefix + 'speaker'] = speaker
+                    followup[prefix + 'speaker_score'] = round(score, 4)
+        try:
+            await self.send(json.dumps(followup))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def track_endpoint(self):
+        # The partial result last changed when the last word was heard, the
+        # audio decoded since then is what the endpointer waited for
+        latency = self.audio_seconds - self.voiced_at
+        ENDPOINT_LATENCY.observe(latency)
+        logging.info('Final result %.2f s after the last voiced audio', latency)
+
+    def idle_response(self):
+        # Answer for a message that did not produce a new partial result
+        if self.partials != 'all' or self.partial_interval:
+            return None
+        return self.last_partial
+
+    def track_lag(self, elapsed, audio):
+        # Seconds this session fell behind real time, it grows while decoding
+        # (queue wait included) takes longer than the audio it covers
+        self.lag = max(0.0, self.lag + elapsed - audio)
+        degraded = args.lag_budget > 0 and self.lag > args.lag_budget
+        if degraded != self.degraded:
+            self.degraded = degraded
+            DEGRADED.inc(1 if degraded else -1)
+            if degraded:
+                logging.warning('Session %.1f s behind real time, skipping partial results', self.lag)
+            else:
+                logging.info('Session caught up with real time')
+
+    def suppress_partial(self, response):
+        # Partial responses only carry the text, so comparing the strings is
+        # enough to see whether it changed
+        if self.partials == 'all' and not self.partial_interval:
+            return False
+        if self.partials == 'none':
+            return True
+        if self.partials == 'changed' and response == self.sent_partial:
+            return True
+        now = time.monotonic()
+        if now - self.sent_at < self.partial_interval:
+            return True
+        self.sent_partial = response
+        self.sent_at = now
+        return False
+
+    async def open_recognizer(self):
+        # Audio in another rate or in float is converted to the rate the model
+        # was trained for before it reaches the recognizer
+        rate = self.sample_rate
+        if int(rate) != args.model_rate or self.format != 'int16':
+            if StreamResampler:
+                self.resampler = StreamResampler(rate, args.model_rate, self.format)
+                rate = args.model_rate
+            elif self.format != 'int16':
+                raise ValueError('numpy is required for %s audio' % self.format)
+        self.rate = rate
+
+        # Check out a warm recognizer, word list is temporary disabled since not every model supports it.
+        # The speaker model is not attached, x-vectors are computed separately
+        self.rec_key, self.rec = await self.loop.run_in_executor(
+            pool, recognizers.checkout, self.entry, rate,
+            self.grammar, self.show_words, self.max_alternatives, None, self.endpointer)
+        if self.chunk_ms > 0:
+            self.buffer = AudioRebuffer(int(rate * self.chunk_ms / 1000) * 2)
+
+    async def release_recognizer(self):
+        if self.rec:
+            await self.loop.run_in_executor(pool, recognizers.checkin, self.rec_key, self.rec)
+            self.rec = None
+            self.buffer = None
+            self.last_partial = EMPTY_PARTIAL
+            self.utterance.clear()
+        if self.resampler:
+            self.resample_cost += self.resampler.cost
+            self.resample_seconds += self.resampler.seconds
+            self.resampler = None
+
+    async def close(self):
+        if self.followups:
+            done, pending = await asyncio.wait(self.followups, timeout=args.spk_timeout)
+            for task in pending:
+                task.cancel()
+        await self.release_recognizer()
+        if self.entry:
+            registry.release(self.entry)
+        if self.degraded:
+            DEGRADED.dec()
+        if self.audio_seconds:
+            SESSION_RTF.observe(self.decode_seconds / self.audio_seconds)
+        logging.info('Session: %d messages, %d decode calls', self.messages, self.decodes)
+        if self.resample_seconds:
+            logging.info('Resampled %.1f s of audio in %.1f ms', self.resample_seconds, self.resample_cost * 1000)
+        logging.info('Recognizer pool %s', recognizers.stats())
+
+def process_request(path, request_headers):
+    if path == '/metrics':
+        return http.HTTPStatus.OK, [('Content-Type', 'text/plain; version=0.0.4')], metrics.render()
+    if path == '/healthz':
+        return http.HTTPStatus.OK, [], b'ok\n'
+    if path == '/ready':
+        if ready:
+            return http.HTTPStatus.OK, [], b'ready\n'
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, [], b'loading\n'
+    if not ready:
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, [('Retry-After', '5')], b'Loading models\n'
+    if admission.full():
+        admission.rejected += 1
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, [('Retry-After', '1')], b'Too many sessions\n'
+
+def tag(stream_id, response):
+    # Put the stream id into a JSON object response without parsing it
+    body = response.lstrip()[1:].lstrip()
+    if body.startswith('}'):
+        return '{"stream" : %d}' % stream_id
+    return '{"stream" : %d, %s' % (stream_id, body)
+
+async def run_stream(stream_id, queue, send):
+    # One logical stream of a multiplexed connection, it has its own session
+    # and handles its messages in order. The admission slot was taken when
+    # the stream was opened and is released here
+    loop = asyncio.get_running_loop()
+    session = Session(loop, lambda text: send(tag(stream_id, text)))
+    try:
+        await session.open()
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            if isinstance(message, dict):
+                await session.configure(message)
+                continue
+            response, stop = await session.process(message)
+            if response is not None:
+                await send(tag(stream_id, response))
+            if stop: break
+    finally:
+        await session.close()
+        admission.release()
+
+async def recognize_mux(websocket, tap_id, opened):
+    """Many audio streams over one connection.
+
+    {"open" : id, "config" : {...}} starts stream id (0-65535), binary
+    messages carry a 2 byte big endian stream id in front of the audio,
+    {"stream" : id, "config" : {...}} reconfigures a stream and
+    {"close" : id} finalizes it. Every response has a "stream" field.
+    """
+    loop = asyncio.get_running_loop()
+    streams = {}
+    tasks = {}
+
+    async def send(text):
+        try:
+            await websocket.send(text)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def error(stream_id, text):
+        return send(json.dumps({'stream': stream_id, 'error': text}))
+
+    def finished(stream_id, task):
+        if tasks.get(stream_id) is task:
+            del tasks[stream_id]
+            streams.pop(stream_id, None)
+        if not task.cancelled() and task.exception():
+            logging.error('Stream %d failed: %r', stream_id, task.exception())
+            asyncio.ensure_future(error(stream_id, 'Stream failed'))
+
+    async def put(stream_id, message):
+        # Waits while the stream's queue is full, unless the stream ends in
+        # the meantime and nobody would ever take the message
+        queue = streams.get(stream_id)
+        task = tasks.get(stream_id)
+        if queue is None:
+            return False
+        if not queue.full():
+            queue.put_nowait(message)
+            return True
+        putter = asyncio.ensure_future(queue.put(message))
+        await asyncio.wait((putter, task), return_when=asyncio.FIRST_COMPLETED)
+        if not putter.done():
+            putter.cancel()
+            return False
+        return True
+
+    try:
+        async for message in websocket:
+            if tap_id:
+                if isinstance(message, str):
+                    tap.record(tap_id, loop.time() - opened, TEXT, message.encode('utf-8'))
+                else:
+                    tap.record(tap_id, loop.time() - opened, BINARY, message)
+
+            if isinstance(message, bytes):
+                if len(message) < 2:
+                    continue
+                stream_id = int.from_bytes(message[:2], 'big')
+                if not await put(stream_id, message[2:]) and stream_id not in tasks:
+                    await error(stream_id, 'Stream is not open')
+                continue
+
+            jobj = json.loads(message)
+            if 'open' in jobj:
+                stream_id = int(jobj['open'])
+                if stream_id in streams or not 0 <= stream_id <= 0xffff:
+                    await error(stream_id, 'Stream id in use or out of range')
+                    continue
+                # A stream can not wait for a slot, its audio would fill the
+                # queue and stall the reader for every other stream
+                if not admission.try_acquire():
+                    await error(stream_id, 'Too many sessions')
+                    continue
+                queue = streams[stream_id] = asyncio.Queue(args.mux_queue)
+                if jobj.get('config'):
+                    queue.put_nowait(jobj['config'])
+                task = tasks[stream_id] = asyncio.ensure_future(run_stream(stream_id, queue, send))
+                task.add_done_callback(lambda t, stream_id=stream_id: finished(stream_id, t))
+            elif 'close' in jobj:
+                stream_id = int(jobj['close'])
+                if await put(stream_id, EOF):
+                    await put(stream_id, None)
+                streams.pop(stream_id, None)
+            elif 'stream' in jobj and 'config' in jobj:
+                await put(int(jobj['stream']), jobj['config'])
+    finally:
+        # Nobody is left to read the results of the streams still open, drop
+        # their pending audio and let them close
+        for queue in streams.values():
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        if tasks:
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+async def recognize(websocket, path):
+    loop = asyncio.get_running_loop()
+
+    logging.info('Connection from %s', websocket.remote_address);
+
+    if path == '/mux':
+        tap_id = tap.open(remote=str(websocket.remote_address), path=path) if tap else None
+        opened = loop.time()
+        try:
+            await recognize_mux(websocket, tap_id, opened)
+        finally:
+            if tap_id:
+                tap.close(tap_id, loop.time() - opened)
+        return
 
-    global model
+    if not await admission.acquire():
+        logging.warning('Rejecting %s, %d sessions active', websocket.remote_address, admission.active)
+        await websocket.close(1013, 'Too many sessions')
+        return
+
+    session = Session(loop, websocket.send)
+    tap_id = tap.open(remote=str(websocket.remote_address), path=path) if tap else None
+    if tap_id:
+        logging.info('Recording session %s', tap_id)
+    opened = loop.time()
+    try:
+        await session.open()
+        while True:
+
+            message = await websocket.recv()
+            if tap_id:
+                if isinstance(message, str):
+                    tap.record(tap_id, loop.time() - opened, TEXT, message.encode('utf-8'))
+                else:
+                    tap.record(tap_id, loop.time() - opened, BINARY, message)
+
+            # Load configuration if provided
+            if isinstance(message, str) and 'config' in message:
+                await session.configure(json.loads(message)['config'])
+                continue
+
+            response, stop = await session.process(message)
+            if response is not None:
+                await websocket.send(response)
+            if stop: break
+    finally:
+        if tap_id:
+            tap.close(tap_id, loop.time() - opened)
+        await session.close()
+        admission.release()
+
+
+
+def setup():
+
+    global registry
+    global recognizers
+    global grammars
     global spk_model
+    global speakers
+    global ready
     global args
-    global pool
 
     # Enable loging if needed
     #
     # logger = logging.getLogger('websockets')
     # logger.setLevel(logging.INFO)
     # logger.addHandler(logging.StreamHandler())
-    logging.basicConfig(level=logging.INFO)
+    logging.basicConfig(level=logging.INFO, format='%(process)d:%(levelname)s:%(name)s:%(message)s')
 
     args = type('', (), {})()
 
@@ -100,10 +641,216 @@ async def start():
     args.sample_rate = float(os.environ.get('VOSK_SAMPLE_RATE', 8000))
     args.max_alternatives = int(os.environ.get('VOSK_ALTERNATIVES', 0))
     args.show_words = bool(os.environ.get('VOSK_SHOW_WORDS', True))
+    args.model_key = 'lang:ja'
+    args.model_cache_mb = int(os.environ.get('VOSK_MODEL_CACHE_MB', 0))
+    args.rec_pool_size = int(os.environ.get('VOSK_REC_POOL_SIZE', 32))
+    args.rec_pool_idle = float(os.environ.get('VOSK_REC_POOL_IDLE', 300))
+    args.model_rate = int(os.environ.get('VOSK_MODEL_SAMPLE_RATE', 16000))
+    args.chunk_ms = int(os.environ.get('VOSK_CHUNK_MS', 200))
+    args.max_sessions = int(os.environ.get('VOSK_MAX_SESSIONS', 0))
+    args.max_waiting = int(os.environ.get('VOSK_MAX_WAITING', 0))
+    args.admission_wait = float(os.environ.get('VOSK_ADMISSION_WAIT', 5))
+    args.lag_budget = float(os.environ.get('VOSK_LAG_BUDGET', 2))
+    args.endpointer = endpointer_config({k: v for k, v in (
+        ('mode', os.environ.get('VOSK_ENDPOINTER_MODE')),
+        ('start_max', os.environ.get('VOSK_ENDPOINTER_START_MAX')),
+        ('end', os.environ.get('VOSK_ENDPOINTER_END')),
+        ('max', os.environ.get('VOSK_ENDPOINTER_MAX'))) if v})
+    args.spk_threads = int(os.environ.get('VOSK_SPK_THREADS', 1))
+    args.spk_min_seconds = float(os.environ.get('VOSK_SPK_MIN_SECONDS', 0.5))
+    args.spk_max_seconds = float(os.environ.get('VOSK_SPK_MAX_SECONDS', 10))
+    args.spk_timeout = float(os.environ.get('VOSK_SPK_TIMEOUT', 5))
+    args.spk_store = os.environ.get('VOSK_SPK_STORE')
+    args.spk_threshold = float(os.environ.get('VOSK_SPK_THRESHOLD', 0.5))
+    args.grammars = os.environ.get('VOSK_GRAMMARS')
+    args.grammar_warm = int(os.environ.get('VOSK_GRAMMAR_WARM', 1))
+    args.grammar_cache = int(os.environ.get('VOSK_GRAMMAR_CACHE', 256))
+    args.workers = int(os.environ.get('VOSK_WORKERS', 1))
+    args.threads = int(os.environ.get('VOSK_THREADS', max(1, (os.cpu_count() or 1) // args.workers)))
+    args.drain_timeout = float(os.environ.get('VOSK_DRAIN_TIMEOUT', 60))
+    args.warmup_seconds = float(os.environ.get('VOSK_WARMUP_SECONDS', 1))
+    args.mux_queue = int(os.environ.get('VOSK_MUX_QUEUE', 64))
+    args.tap_dir = os.environ.get('VOSK_TAP_DIR')
+    args.tap_queue = int(os.environ.get('VOSK_TAP_QUEUE', 1000))
+    args.tap_segment_mb = float(os.environ.get('VOSK_TAP_SEGMENT_MB', 16))
+    args.tap_max_mb = float(os.environ.get('VOSK_TAP_MAX_MB', 1024))
+    args.tap_max_days = float(os.environ.get('VOSK_TAP_MAX_DAYS', 7))
 
     if len(sys.argv) > 1:
        args.model_path = sys.argv[1]
 
+    registry = ModelRegistry(args.model_cache_mb)
+    recognizers = RecognizerPool(args.rec_pool_size, args.rec_pool_idle)
+    registry.listeners.append(lambda entry: recognizers.discard(entry.ident))
+    grammars = GrammarCache(args.grammar_cache)
+    spk_model = None
+    speakers = None
+    ready = False
+
+
+def load_models():
+    # Load the model and the speaker model side by side, vosk releases the
+    # GIL while loading. Then compile the named grammars and run synthetic
+    # audio through a recognizer so the first real session does not pay for
+    # cold caches and page faults
+    global spk_model
+    global speakers
+
+    started = time.monotonic()
+    phases = []
+
+    def timed_load(loader, *load_args):
+        t = time.monotonic()
+        return loader(*load_args), time.monotonic() - t
+
+    with concurrent.futures.ThreadPoolExecutor(2) as loaders:
+        model_job = loaders.submit(timed_load, load_model, args.model_key)
+        spk_job = loaders.submit(timed_load, SpkModel, args.spk_model_path) if args.spk_model_path else None
+        model, seconds = model_job.result()
+        phases.append(('model', seconds))
+        if spk_job:
+            spk_model, seconds = spk_job.result()
+            phases.append(('spk_model', seconds))
+    entry = registry.add(args.model_key, model, pinned=True)
+    phases.append(('load', time.monotonic() - started))
+
+    if args.spk_store and spk_model and SpeakerStore:
+        t = time.monotonic()
+        speakers = SpeakerStore(args.spk_store)
+        phases.append(('speakers', time.monotonic() - t))
+
+    if args.grammars:
+        t = time.monotonic()
+        grammars.load(args.grammars)
+        prewarm_grammars(entry)
+        phases.append(('grammars', time.monotonic() - t))
+
+    if args.warmup_seconds > 0:
+        t = time.monotonic()
+        warmup(entry)
+        phases.append(('warmup', time.monotonic() - t))
+
+    logging.info('Startup: %s, total %.2f s', ', '.join('%s %.2f s' % p for p in phases),
+                 time.monotonic() - started)
+
+
+def warmup(entry):
+    # Low level noise through the recognizer a default session checks out,
+    # which is then left warm in the pool
+    rate = args.model_rate if StreamResampler else args.sample_rate
+    noise = random.Random(0)
+    samples = int(rate * args.warmup_seconds)
+    audio = struct.pack('<%dh' % samples, *(noise.randint(-300, 300) for _ in range(samples)))
+    key, rec = recognizers.checkout(entry, rate, None, args.show_words, args.max_alternatives, None,
+                                    args.endpointer)
+    try:
+        rec.AcceptWaveform(audio)
+        rec.FinalResult()
+    finally:
+        recognizers.checkin(key, rec)
+    if spk_model:
+        extract_xvector(recognizers, entry, rate, audio, spk_model)
+
+
+def warm_reloaded(entry):
+    # A reloaded model gets the same preparation as at startup, so the first
+    # session after a reload does not meet a cold recognizer either
+    prewarm_grammars(entry)
+    if entry.key == args.model_key and args.warmup_seconds > 0:
+        warmup(entry)
+
+
+def prewarm_grammars(entry):
+    # Compile the named grammars once at startup and park the recognizers in
+    # the pool, clients referring to them by name get a warm one
+    if entry.key != args.model_key:
+        return
+    rate = args.model_rate if StreamResampler else args.sample_rate
+    for name, grammar in grammars.named.items():
+        started = time.monotonic()
+        warm = [recognizers.checkout(entry, rate, grammar, args.show_words, args.max_alternatives, None,
+                                     args.endpointer)
+                for _ in range(args.grammar_warm)]
+        for key, rec in warm:
+            recognizers.checkin(key, rec)
+        logging.info('Grammar %s compiled in %.2f s', name, time.monotonic() - started)
+
+
+async def reload_models():
+    # SIGHUP: load every model again in the background. New sessions switch
+    # once a model is ready, running sessions finish on the old one
+    global reloading
+
+    if not ready:
+        logging.warning('Models are still loading, reload ignored')
+        return
+    if reloading:
+        logging.warning('Model reload already in progress')
+        return
+    reloading = True
+    try:
+        for key in list(registry.entries):
+            started = time.monotonic()
+            try:
+                entry = await registry.reload(key, warm=warm_reloaded)
+            except Exception as e:
+                logging.error('Reloading model %s failed: %s', key, e)
+                continue
+            logging.info('Model %s reloaded in %.1f s', entry.ident, time.monotonic() - started)
+    finally:
+        reloading = False
+
+
+def reload_forked():
+    # Prefork reload: the supervisor loads the new models once, the workers
+    # are then replaced by ones forked from them. Returns the number of
+    # models reloaded
+    reloaded = 0
+    for key, old in list(registry.entries.items()):
+        started = time.monotonic()
+        try:
+            entry = registry.add(key, load_model(key), pinned=old.pinned)
+        except Exception as e:
+            logging.error('Reloading model %s failed: %s', key, e)
+            continue
+        recognizers.discard(old.ident)
+        warm_reloaded(entry)
+        reloaded += 1
+        logging.info('Model %s reloaded in %.1f s', entry.ident, time.monotonic() - started)
+    gc.freeze()
+    return reloaded
+
+
+async def drain(server, stopped):
+    # A prefork worker replaced after a reload stops accepting, lets its
+    # connections finish on the old model for up to VOSK_DRAIN_TIMEOUT and
+    # then exits. The kernel sends new connections to the other listeners
+    global ready
+
+    if not server.server.is_serving():
+        return
+    ready = False
+    server.server.close()
+    logging.info('Draining %d connections', len(server.websockets))
+    deadline = time.monotonic() + args.drain_timeout
+    while server.websockets and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+    if server.websockets:
+        logging.warning('Closing %d connections still open after %.0f s', len(server.websockets),
+                        args.drain_timeout)
+    stopped.set_result(None)
+
+
+async def start():
+
+    global args
+    global pool
+    global spk_pool
+    global admission
+    global reloading
+    global ready
+    global tap
+
     # Gpu part, uncomment if vosk-api has gpu support
     #
     # from vosk import GpuInit, GpuInstantiate
@@ -112,14 +859,113 @@ async def start():
     #     GpuInstantiate()
     # pool = concurrent.futures.ThreadPoolExecutor(initializer=thread_init)
 
-    model = Model(lang="ja")
-    spk_model = SpkModel(args.spk_model_path) if args.spk_model_path else None
+    loop = asyncio.get_running_loop()
+    pool = concurrent.futures.ThreadPoolExecutor(args.threads)
+    admission = Admission(args.max_sessions, args.max_waiting, args.admission_wait)
+    reloading = False
+    # The writer thread belongs to this process, so every worker has its own
+    tap = AudioTap(args.tap_dir, args.tap_queue, int(args.tap_segment_mb * 1024 * 1024),
+                   int(args.tap_max_mb * 1024 * 1024), args.tap_max_days * 86400) if args.tap_dir else None
+
+    # Bind first so /healthz answers while the models load, /ready and new
+    # sessions get 503 until they are loaded and warm. Forked workers get
+    # the models from the supervisor
+    started = time.monotonic()
+    stopped = loop.create_future()
+    async with websockets.serve(recognize, args.interface, args.port, reuse_port=args.workers > 1,
+                                process_request=process_request) as server:
+        logging.info('Listening on %s:%d after %.2f s', args.interface, args.port, time.monotonic() - started)
+        if args.workers > 1:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(drain(server, stopped)))
+        else:
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload_models()))
+        if args.model_key not in registry.entries:
+            await loop.run_in_executor(pool, load_models)
+        spk_pool = concurrent.futures.ThreadPoolExecutor(args.spk_threads) if spk_model else None
+        ready = True
+        logging.info('Ready')
+        await stopped
+
+
+def worker():
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        asyncio.run(start())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os._exit(0)
+
+
+def prefork():
+    """Fork args.workers copies of the server after the models are loaded.
+
+    Every worker binds the same port with SO_REUSEPORT and the kernel spreads
+    connections between them. The model pages were written before the fork
+    and stay shared copy-on-write. Crashed workers are restarted.
+    """
+    children = {}
+    retiring = set()
+    stopping = False
 
-    pool = concurrent.futures.ThreadPoolExecutor((os.cpu_count() or 1))
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            worker()
+        children[pid] = time.monotonic()
+        logging.info('Started worker %d', pid)
 
-    async with websockets.serve(recognize, args.interface, args.port):
-        await asyncio.Future()
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    def reload(signum, frame):
+        # A rolling restart keeps the models shared: new workers fork from
+        # the models reloaded here, the old ones drain and exit
+        if not reload_forked():
+            return
+        for pid in [pid for pid in children if pid not in retiring]:
+            spawn()
+            retiring.add(pid)
+            os.kill(pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    # Keep the loaded model out of the collector so refcount updates do not
+    # dirty shared pages in the workers
+    gc.freeze()
+
+    for _ in range(args.workers):
+        spawn()
+
+    try:
+        while children:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+            if pid in retiring:
+                retiring.discard(pid)
+                logging.info('Worker %d drained', pid)
+                continue
+            logging.warning('Worker %d exited with status %d, restarting', pid, status)
+            if time.monotonic() - started < 1.0:
+                time.sleep(1.0)
+            spawn()
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+        for pid in list(children):
+            os.waitpid(pid, 0)
 
 
 if __name__ == '__main__':
-    asyncio.run(start())
+    setup()
+    if args.workers > 1:
+        load_models()
+        prefork()
+    else:
+        asyncio.run(start())
@@ -7,7 +7,16 @@ import asyncio
 import websockets
 import concurrent.futures
 import logging
-from vosk import Model, SpkModel, KaldiRecognizer
+from vosk import Model, SpkModel
+from model_registry import ModelRegistry
+from model_registry import model_key
+from recognizer_pool import RecognizerPool
+from grammars import canonical_grammar
+from vad_gate import VadGate
+from session_parking import SessionParking
+from session_parking import new_token
+
+SILENCE = '{\n  "partial" : ""\n}'
 
 def process_chunk(rec, message):
     if message == b'{"eof" : 1}':
@@ -19,79 +28,179 @@ def process_chunk(rec, message):
     else:
         return rec.PartialResult(), False
 
+def process_voiced(rec, audio, end_of_speech):
+    if audio and rec.AcceptWaveform(audio):
+        return rec.Result(), False
+    if end_of_speech:
+        return rec.FinalResult(), False
+    return rec.PartialResult(), False
+
+def release_state(state):
+    # A parked session that was not resumed in time. The model may only be
+    # evicted once its recognizer is back in the pool
+    if state['rec']:
+        checkin = asyncio.get_running_loop().run_in_executor(
+            pool, recognizers.checkin, state['rec_key'], state['rec'])
+        checkin.add_done_callback(lambda f: registry.release(state['entry']))
+    else:
+        registry.release(state['entry'])
+
 async def recognize(websocket, path):
-    global model
+    global registry
+    global recognizers
     global spk_model
     global args
     global pool
+    global parking
 
     loop = asyncio.get_running_loop()
     rec = None
-    phrase_list = None
+    rec_key = None
+    grammar = None
     sample_rate = args.sample_rate
     show_words = args.show_words
     max_alternatives = args.max_alternatives
-    model_changed = False
+    vad_conf = args.vad
+    vad = None
+    dropped = 0.0
+    token = None
+    audio_bytes = 0
+    lost = False
 
     logging.info('Connection from %s', websocket.remote_address);
 
+    entry = await registry.acquire(args.model_key)
+
     try:
         while True:
             try:
                 message = await websocket.recv()
             except websockets.exceptions.ConnectionClosed as e:
                 logging.warning(f"WebSocket connection closed: {e}")
+                lost = isinstance(e, websockets.exceptions.ConnectionClosedError)
                 break
 
             # Handle configuration messages
             if isinstance(message, str) and 'config' in message:
                 jobj = json.loads(message)['config']
                 logging.info("Config %s", jobj)
+
+                # {"resume" : true} asks for a session token, a token takes
+                # over the state parked when that session's connection dropped
+                if 'resume' in jobj:
+                    state = parking.claim(jobj['resume']) if isinstance(jobj['resume'], str) else None
+                    if state:
+                        if rec:
+                            await loop.run_in_executor(pool, recognizers.checkin, rec_key, rec)
+                        registry.release(entry)
+                        token = jobj['resume']
+                        (entry, rec, rec_key, grammar, sample_rate, show_words, max_alternatives,
+                         vad_conf, vad, dropped, audio_bytes) = (
+                            state['entry'], state['rec'], state['rec_key'], state['grammar'],
+                            state['sample_rate'], state['show_words'], state['max_alternatives'],
+                            state['vad_conf'], state['vad'], state['dropped'], state['audio_bytes'])
+                        logging.info('Resumed session after %d audio bytes', audio_bytes)
+                    elif token is None:
+                        token = new_token()
+                    await websocket.send(json.dumps({'session': token, 'resumed': state is not None,
+                                                     'audio_bytes': audio_bytes}))
+                    # A resumed session keeps the configuration it was parked
+                    # with, a new one applies the rest of this message
+                    if state:
+                        continue
+
+                if rec:
+                    await loop.run_in_executor(pool, recognizers.checkin, rec_key, rec)
+                    rec = None
+                if vad:
+                    dropped += vad.dropped_seconds
+                    vad = None
                 if 'phrase_list' in jobj:
-                    phrase_list = jobj['phrase_list']
+                    grammar = canonical_grammar(jobj['phrase_list'])
                 if 'sample_rate' in jobj:
                     sample_rate = float(jobj['sample_rate'])
                 if 'model' in jobj:
-                    model = Model(jobj['model'])
-                    model_changed = True
+                    new_entry = await registry.acquire(model_key(jobj['model']))
+                    registry.release(entry)
+                    entry = new_entry
                 if 'words' in jobj:
                     show_words = bool(jobj['words'])
                 if 'max_alternatives' in jobj:
                     max_alternatives = int(jobj['max_alternatives'])
+                if 'vad' in jobj:
+                    # false or null turn VAD off, 0 is the least aggressive mode
+                    if jobj['vad'] is None or jobj['vad'] is False:
+                        vad_conf = None
+                    elif jobj['vad'] is True:
+                        vad_conf = 3
+                    else:
+                        vad_conf = jobj['vad']
                 continue
 
-            # Create or update the recognizer
-            if not rec or model_changed:
-                model_changed = False
-                if phrase_list:
-                    rec = KaldiRecognizer(model, sample_rate, json.dumps(phrase_list, ensure_ascii=False))
-                else:
-                    rec = KaldiRecognizer(model, sample_rate)
-                rec.SetWords(show_words)
-                rec.SetMaxAlternatives(max_alternatives)
-                if spk_model:
-                    rec.SetSpkModel(spk_model)
+            # Check out a warm recognizer matching the current configuration
+            if not rec:
+                rec_key, rec = await loop.run_in_executor(pool, recognizers.checkout, entry, sample_rate,
+                                                          grammar, show_words, max_alternatives, spk_model)
+                if vad_conf is not None:
+                    try:
+                        vad = VadGate.from_config(sample_rate, vad_conf)
+                    except ValueError as e:
+                        logging.warning(f"VAD disabled: {e}")
+                        vad_conf = None
 
             # Ensure message is bytes for audio data
             if isinstance(message, str):
                 message = message.encode('utf-8')
 
-            response, stop = await loop.run_in_executor(pool, process_chunk, rec, message)
+            # Only voiced audio reaches the decoder, silence is answered
+            # without touching the recognizer
+            if vad and message not in (b'{"eof" : 1}', b'{"reset" : 1}'):
+                audio, end_of_speech = vad.process(message)
+                if not audio and not end_of_speech:
+                    await websocket.send(SILENCE)
+                    continue
+                response, stop = await loop.run_in_executor(pool, process_voiced, rec, audio, end_of_speech)
+            else:
+                response, stop = await loop.run_in_executor(pool, process_chunk, rec, message)
+            if message not in (b'{"eof" : 1}', b'{"reset" : 1}'):
+                audio_bytes += len(message)
             await websocket.send(response)
             if stop:
                 break
 
+    except websockets.exceptions.ConnectionClosedError as e:
+        logging.warning(f"WebSocket connection lost: {e}")
+        lost = True
+
     except Exception as e:
         logging.error(f"Error in WebSocket handler: {e}")
 
     finally:
+        if lost and token:
+            parking.park(token, {
+                'entry': entry, 'rec': rec, 'rec_key': rec_key, 'grammar': grammar,
+                'sample_rate': sample_rate, 'show_words': show_words,
+                'max_alternatives': max_alternatives, 'vad_conf': vad_conf, 'vad': vad,
+                'dropped': dropped, 'audio_bytes': audio_bytes})
+            logging.info('Parked session for %.0f s, %d parked', args.resume_grace, len(parking))
+        else:
+            if rec:
+                await loop.run_in_executor(pool, recognizers.checkin, rec_key, rec)
+            registry.release(entry)
+            if vad:
+                dropped += vad.dropped_seconds
+            if dropped:
+                logging.info('VAD skipped %.1f seconds of silence', dropped)
+        logging.info('Recognizer pool %s', recognizers.stats())
         await websocket.close()
 
 async def start():
-    global model
+    global registry
+    global recognizers
     global spk_model
     global args
     global pool
+    global parking
 
     logging.basicConfig(level=logging.INFO)
 
@@ -104,12 +213,23 @@ async def start():
     args.sample_rate = float(os.environ.get('VOSK_SAMPLE_RATE', 8000))
     args.max_alternatives = int(os.environ.get('VOSK_ALTERNATIVES', 0))
     args.show_words = bool(os.environ.get('VOSK_SHOW_WORDS', True))
+    args.model_key = 'lang:ja'
+    args.model_cache_mb = int(os.environ.get('VOSK_MODEL_CACHE_MB', 0))
+    args.rec_pool_size = int(os.environ.get('VOSK_REC_POOL_SIZE', 32))
+    args.rec_pool_idle = float(os.environ.get('VOSK_REC_POOL_IDLE', 300))
+    args.vad = int(os.environ['VOSK_VAD']) if os.environ.get('VOSK_VAD') else None
+    args.resume_grace = float(os.environ.get('VOSK_RESUME_GRACE', 30))
+    args.resume_max = int(os.environ.get('VOSK_RESUME_MAX', 16))
 
     if len(sys.argv) > 1:
        args.model_path = sys.argv[1]
 
-    model = Model(lang="ja")
+    registry = ModelRegistry(args.model_cache_mb)
+    registry.add(args.model_key, Model(lang="ja"), pinned=True)
+    recognizers = RecognizerPool(args.rec_pool_size, args.rec_pool_idle)
+    registry.listeners.append(lambda entry: recognizers.discard(entry.ident))
     spk_model = SpkModel(args.spk_model_path) if args.spk_model_path else None
+    parking = SessionParking(args.resume_grace, args.resume_max, release_state)
 
     pool = concurrent.futures.ThreadPoolExecutor((os.cpu_count() or 1))
 
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+class AudioRebuffer:
+    """Coalesce small audio messages into decode sized blocks.
+
+    Messages are copied once into a preallocated buffer through a memoryview
+    and handed out as a single block when at least chunk_bytes are collected.
+    A message that is already large enough on an empty buffer is passed
+    through untouched. Blocks always hold whole 16-bit samples.
+    """
+
+    def __init__(self, chunk_bytes):
+        self.chunk_bytes = chunk_bytes - chunk_bytes % 2
+        self.buffer = bytearray(2 * self.chunk_bytes)
+        self.view = memoryview(self.buffer)
+        self.fill = 0
+
+    def feed(self, data):
+        """Add audio, return a block ready for decoding or None."""
+        n = len(data)
+        if self.fill == 0 and n >= self.chunk_bytes and n % 2 == 0:
+            return data
+        if self.fill + n > len(self.buffer):
+            self._grow(self.fill + n)
+        self.view[self.fill:self.fill + n] = data
+        self.fill += n
+        if self.fill < self.chunk_bytes:
+            return None
+        return self._take(self.fill - self.fill % 2)
+
+    def flush(self):
+        """Return whatever is buffered, e.g. before eof or a reset."""
+        return self._take(self.fill)
+
+    def _take(self, n):
+        block = bytes(self.view[:n])
+        rest = self.fill - n
+        if rest:
+            self.view[:rest] = self.view[n:self.fill]
+        self.fill = rest
+        return block
+
+    def _grow(self, size):
+        self.view.release()
+        self.buffer.extend(bytes(size - len(self.buffer)))
+        self.view = memoryview(self.buffer)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+import itertools
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+# Every record is a header (seconds since the session started, kind, payload
+# length) followed by the payload. H is a JSON session header, T a text
+# message, B a binary message and E the end of the session
+RECORD = struct.Struct('<dcI')
+HEADER = b'H'
+TEXT = b'T'
+BINARY = b'B'
+END = b'E'
+
+def read_records(path):
+    """Yield (seconds, kind, payload) of one segment file."""
+    with open(path, 'rb') as f:
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            seconds, kind, size = RECORD.unpack(head)
+            payload = f.read(size)
+            if len(payload) < size:
+                return
+            yield seconds, kind, payload
+
+def session_segments(directory, session_id):
+    names = sorted(n for n in os.listdir(directory) if n.startswith(session_id + '.') and n.endswith('.tap'))
+    return [os.path.join(directory, n) for n in names]
+
+class AudioTap:
+    """Recorder of the messages sessions receive, for replay and debugging.
+
+    Sessions hand records to a bounded queue and a background thread appends
+    them to <session>.<segment>.tap files in directory, starting a new
+    segment after segment_bytes. When the queue is full records are dropped
+    and counted rather than making the session wait for the disk. Segments
+    beyond max_bytes in total or older than max_age seconds are deleted,
+    oldest first.
+    """
+
+    def __init__(self, directory, max_queue=1000, segment_bytes=16 << 20, max_bytes=1 << 30, max_age=0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue = queue.Queue(max_queue)
+        self.files = {}
+        self.closing = set()
+        self.counter = itertools.count(1)
+        self.prefix = '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.dropped = 0
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='audio-tap', daemon=True)
+        self.thread.start()
+
+    def open(self, **header):
+        """Start recording a session, return its id."""
+        session_id = '%s-%d' % (self.prefix, next(self.counter))
+        header['started'] = time.time()
+        self.record(session_id, 0.0, HEADER, json.dumps(header, ensure_ascii=False).encode('utf-8'))
+        return session_id
+
+    def record(self, session_id, seconds, kind, payload):
+        try:
+            self.queue.put_nowait((session_id, seconds, kind, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, session_id, seconds):
+        try:
+            self.queue.put_nowait((session_id, seconds, END, b''))
+        except queue.Full:
+            # Without the end record the writer closes the file once it
+            # catches up
+            self.dropped += 1
+            self.closing.add(session_id)
+
+    def _run(self):
+        while True:
+            session_id, seconds, kind, payload = self.queue.get()
+            try:
+                self._write(session_id, seconds, kind, payload)
+            except OSError as e:
+                logging.error('Audio tap %s: %s', session_id, e)
+            while self.closing and self.queue.empty():
+                entry = self.files.pop(self.closing.pop(), None)
+                if entry:
+                    entry[0].close()
+
+    def _write(self, session_id, seconds, kind, payload):
+        entry = self.files.get(session_id)
+        if entry is None or (entry[0].tell() >= self.segment_bytes and kind != END):
+            segment = 0
+            if entry is not None:
+                entry[0].close()
+                segment = entry[1] + 1
+                self._retain()
+            path = os.path.join(self.directory, '%s.%04d.tap' % (session_id, segment))
+            entry = self.files[session_id] = (open(path, 'ab'), segment)
+        f = entry[0]
+        f.write(RECORD.pack(seconds, kind, len(payload)))
+        f.write(payload)
+        self.written += RECORD.size + len(payload)
+        if kind == END:
+            f.close()
+            del self.files[session_id]
+            self._retain()
+
+    def _retain(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tap'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                segments.append((st.st_mtime, st.st_size, path))
+        segments.sort()
+        open_paths = set(f.name for f, _ in self.files.values())
+        total = sum(size for _, size, _ in segments)
+        now = time.time()
+        for mtime, size, path in segments:
+            expired = self.max_age and now - mtime > self.max_age
+            if not expired and (not self.max_bytes or total <= self.max_bytes):
+                break
+            if path in open_paths:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
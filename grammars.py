@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import json
+from collections import OrderedDict
+
+def canonical_grammar(phrase_list):
+    """Grammar JSON that is the same for any order or duplicates of the phrases.
+
+    An empty list means no grammar and gives None.
+    """
+    phrases = sorted(set(p.strip() for p in phrase_list or () if p and p.strip()))
+    if not phrases:
+        return None
+    return json.dumps(phrases, ensure_ascii=False)
+
+class GrammarCache:
+    """Named grammars and the canonical form of recently seen phrase lists.
+
+    Equal vocabularies map to the same grammar string, so the recognizer
+    pool hands out an already compiled recognizer instead of building a new
+    grammar FST.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.named = {}
+        self.recent = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, name, phrase_list):
+        self.named[name] = canonical_grammar(phrase_list)
+
+    def load(self, path):
+        """Register every grammar of a JSON file {"name" : ["phrase", ...]}."""
+        with open(path, encoding='utf-8') as f:
+            for name, phrase_list in json.load(f).items():
+                self.register(name, phrase_list)
+
+    def lookup(self, name):
+        if name not in self.named:
+            raise ValueError('Unknown grammar %s' % name)
+        return self.named[name]
+
+    def canonical(self, phrase_list):
+        raw = json.dumps(phrase_list, ensure_ascii=False)
+        if raw in self.recent:
+            grammar = self.recent[raw]
+            self.hits += 1
+            self.recent.move_to_end(raw)
+            return grammar
+        self.misses += 1
+        grammar = canonical_grammar(phrase_list)
+        self.recent[raw] = grammar
+        if len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+        return grammar
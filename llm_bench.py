@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import json
+import time
+import warnings
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+def per_turn(func, turns):
+    func()
+    started = time.perf_counter()
+    for _ in range(turns):
+        func()
+    return (time.perf_counter() - started) / turns
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-turn orchestration overhead of the LLM server, with a fake chat model as backend")
+    parser.add_argument('-m', '--module', default='llm_server3', help='llm_server3 or llm_server3t')
+    parser.add_argument('-n', '--turns', type=int, default=200, help='turns per measurement')
+    parser.add_argument('-t', '--text', default='こんにちは、今日は何曜日ですか？', help='user input')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    server = importlib.import_module(args.module)
+    server.llm = FakeListChatModel(responses=['はい、今日は月曜日です。散歩に行きましょう。'])
+    server.chain = server.build_chain()
+    server.runnable_with_history = server.build_runnable(server.chain)
+
+    request = {"user_input": args.text}
+    config = {"configurable": {"session_id": "bench"}}
+
+    # The fake model alone is what a real backend would replace, everything
+    # above it is orchestration
+    backend = per_turn(lambda: server.llm.invoke(args.text), args.turns)
+    rebuilt = per_turn(lambda: server.build_runnable(server.build_chain()).invoke(request, config=config),
+                       args.turns)
+    reused = per_turn(lambda: server.runnable_with_history.invoke(request, config=config), args.turns)
+
+    print(json.dumps({
+        'module': args.module,
+        'turns': args.turns,
+        'backend_ms': round(backend * 1000, 3),
+        'overhead_rebuilt_ms': round((rebuilt - backend) * 1000, 3),
+        'overhead_reused_ms': round((reused - backend) * 1000, 3),
+        'saved_ms': round((rebuilt - reused) * 1000, 3),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
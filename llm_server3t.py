@@ -2,15 +2,22 @@
 # from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
 import asyncio
+import collections
 import websockets
 import json
 import os
+import re
 
 from langchain_openai import ChatOpenAI
 
 API_KEY = "EMPTY"
 API_BASE = "http://192.168.11.101:8080/v1"
 MODEL = "llama-3"
+# Requests the server sends to the backend at the same time
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+# Histories of sessions named by clients kept for reconnects, the least
+# recently used are forgotten beyond this
+LLM_MAX_SESSIONS = int(os.environ.get("LLM_MAX_SESSIONS", 64))
 
 # from langchain.prompts import (
 from langchain_core.prompts import (
@@ -22,6 +29,7 @@ from langchain_core.prompts import (
 
 from langchain_core.messages import SystemMessage
 from langchain_core.messages import BaseMessage
+from langchain_core.messages import AIMessage, HumanMessage
 
 from langchain_core.output_parsers import StrOutputParser
 
@@ -149,35 +157,60 @@ class LimitedChatMessageHistory(ChatMessageHistory):
         if len(self.messages) > self.max_messages:
             self.messages = self.messages[-self.max_messages :]
 
-store = {}
-memory = LimitedChatMessageHistory(max_messages=5)
+store = collections.OrderedDict()
+locks = {}
+# Last turn streamed with "commit" : false per session, until the client
+# commits it
+pending = {}
+backend = None
 
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
     if session_id not in store:
-        store[session_id] = memory
+        store[session_id] = LimitedChatMessageHistory(max_messages=5)
+        forget_sessions()
+    store.move_to_end(session_id)
     return store[session_id]
 
+def forget_sessions():
+    # Connection histories go when their connection closes, named ones only
+    # here. A session with a turn in progress is kept
+    named = [session_id for session_id in store if not session_id.startswith("connection-")]
+    for session_id in named[:max(0, len(named) - LLM_MAX_SESSIONS)]:
+        lock = locks.get(session_id)
+        if lock is not None and lock.locked():
+            continue
+        del store[session_id]
+        locks.pop(session_id, None)
+        pending.pop(session_id, None)
+
+def build_chain():
+    prompt = ChatPromptTemplate.from_messages(
+        [
+            SystemMessage(content=template),
+            MessagesPlaceholder(variable_name="history"),
+            HumanMessagePromptTemplate.from_template("{user_input}"),
+        ]
+    )
+
+    parser = StrOutputParser()
+
+    return prompt | llm | parser
+
+def build_runnable(chain):
+    return RunnableWithMessageHistory(
+        chain,
+        get_session_history,
+        input_messages_key="user_input",
+        history_messages_key="history",
+    )
+
+# Built once, only the per-request config differs between turns
+chain = build_chain()
+runnable_with_history = build_runnable(chain)
+
 def llm_main(user_input):
     if user_input:
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                SystemMessage(content=template),
-                MessagesPlaceholder(variable_name="history"),
-                HumanMessagePromptTemplate.from_template("{user_input}"),
-            ]
-        )
-
-        parser = StrOutputParser()
-
-        chain = prompt | llm | parser
-
-        runnable_with_history = RunnableWithMessageHistory(
-            chain,
-            get_session_history,
-            input_messages_key="user_input",
-            history_messages_key="history",
-        )
         response = runnable_with_history.invoke(
             {"user_input": user_input},
             config={"configurable": {"session_id": "123"}},
@@ -186,6 +219,13 @@ def llm_main(user_input):
         # print(type(response))
         # print(response)
         return response
+
+async def llm_main_async(user_input, session_id="123"):
+    if user_input:
+        return await runnable_with_history.ainvoke(
+            {"user_input": user_input},
+            config={"configurable": {"session_id": session_id}},
+        )
        
 def main_():
     while True:
@@ -200,44 +240,139 @@ def main_():
             print("Assistant: ",response)
     
 
+SENTENCE_END = re.compile(r'[。！？!?\n]+')
+
+def pop_sentences(buffer):
+    """Split the complete sentences off the front of buffer, return (sentences, rest).
+
+    A boundary at the very end of buffer is left for the next chunk, which
+    may continue it (e.g. "！？").
+    """
+    sentences = []
+    start = 0
+    for m in SENTENCE_END.finditer(buffer):
+        if m.end() == len(buffer):
+            break
+        sentence = buffer[start:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    return sentences, buffer[start:]
+
+async def stream_reply(websocket, user_input, session_id="123", commit=True):
+    """Send the reply sentence by sentence as it is generated.
+
+    Frames are {"seq" : n, "text" : sentence} and the turn ends with
+    {"seq" : n, "end" : true}. The turn is added to the history only after
+    the end frame was sent, a turn cut short by a closed connection or an
+    error is forgotten. With commit=False the finished turn is kept aside
+    until the client commits it.
+    """
+    history = get_session_history(session_id)
+    seq = 0
+    buffer = ""
+    reply = ""
+    async for chunk in chain.astream({"user_input": user_input, "history": history.messages}):
+        reply += chunk
+        sentences, buffer = pop_sentences(buffer + chunk)
+        for sentence in sentences:
+            await websocket.send(json.dumps({"seq": seq, "text": sentence}, ensure_ascii=False))
+            seq += 1
+    if buffer.strip():
+        await websocket.send(json.dumps({"seq": seq, "text": buffer.strip()}, ensure_ascii=False))
+        seq += 1
+    await websocket.send(json.dumps({"seq": seq, "end": True}))
+    turn = [HumanMessage(content=user_input), AIMessage(content=reply)]
+    if commit:
+        history.add_messages(turn)
+    else:
+        pending[session_id] = turn
+    return reply
+
+async def until_closed(websocket, coro):
+    """Run coro, cancel it if the client disconnects first.
+
+    Returns (True, result), or (False, None) when the connection closed
+    before the reply was ready. A cancelled turn is not added to the history.
+    """
+    task = asyncio.ensure_future(coro)
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    try:
+        await asyncio.wait((task, closed), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        closed.cancel()
+    if not task.done():
+        task.cancel()
+        return False, None
+    return True, task.result()
+
 async def handle_connection(websocket, path):
-    async for message in websocket:
-        print(f"Received message: {message}")
-
-        # response = conversation.predict(input=message)
-        response = llm_main(user_input=message)
-
-# stream output
-        # prompt = ChatPromptTemplate.from_messages(
-        #     [
-        #         SystemMessage(content=template),
-        #         MessagesPlaceholder(variable_name="history"),
-        #         HumanMessagePromptTemplate.from_template("{user_input}"),
-        #     ]
-        # )
-
-        # parser = StrOutputParser()
-
-        # chain = prompt | llm | parser
-
-        # runnable_with_history = RunnableWithMessageHistory(
-        #     chain,
-        #     get_session_history,
-        #     input_messages_key="user_input",
-        #     history_messages_key="history",
-        # )
-    
-        # async for chunk in runnable_with_history.astream({"user_input": message},
-        #     config={"configurable": {"session_id": "123"}},
-        # ):
-        #     await websocket.send(chunk)
-        #     print(f"Sent response: {chunk}")
-# stream output
- 
-        await websocket.send(response)
-        print(f"Sent response: {response}")
+    # Without a "session" in the request the history belongs to this
+    # connection. The server binds localhost, so the client host can not
+    # tell the clients apart
+    connection_session = "connection-%d" % id(websocket)
+    try:
+        async for message in websocket:
+            print(f"Received message: {message}")
+
+            # {"text" : "...", "stream" : true} asks for sentence frames, any
+            # other message is the user input and gets the whole reply at once
+            request = None
+            if message.startswith("{"):
+                try:
+                    request = json.loads(message)
+                except ValueError:
+                    pass
+            # {"session" : "...", "commit" : true} adds the turn last streamed
+            # with "commit" : false, e.g. a speculative request whose answer
+            # the client used
+            if isinstance(request, dict) and "text" not in request and request.get("commit") is True:
+                session_id = str(request.get("session") or connection_session)
+                async with locks.setdefault(session_id, asyncio.Lock()):
+                    turn = pending.pop(session_id, None)
+                    if turn:
+                        get_session_history(session_id).add_messages(turn)
+                print(f"Committed turn of {session_id}: {turn is not None}")
+                continue
+            if not (isinstance(request, dict) and "text" in request):
+                request = {"text": message}
+
+            # A client that names its session keeps the conversation across
+            # reconnects. Turns of one history run one after the other,
+            # different sessions run concurrently up to LLM_MAX_CONCURRENCY
+            # backend requests
+            session_id = str(request.get("session") or connection_session)
+            lock = locks.setdefault(session_id, asyncio.Lock())
+            async with lock, backend:
+                # A new turn supersedes one that was never committed
+                pending.pop(session_id, None)
+                if request.get("stream"):
+                    reply = stream_reply(websocket, request["text"], session_id, request.get("commit") is not False)
+                else:
+                    # response = conversation.predict(input=message)
+                    reply = llm_main_async(request["text"], session_id)
+                completed, response = await until_closed(websocket, reply)
+
+            if not completed:
+                print("Client disconnected, request cancelled")
+                return
+            if request.get("stream"):
+                print(f"Streamed response: {response}")
+                continue
+            await websocket.send(response)
+            print(f"Sent response: {response}")
+    finally:
+        store.pop(connection_session, None)
+        locks.pop(connection_session, None)
+        pending.pop(connection_session, None)
 
 async def main():
+    global backend
+
+    backend = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
     async with websockets.serve(handle_connection, "localhost", 8765):
         await asyncio.Future()  # Run forever
 
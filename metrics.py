@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import bisect
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.func() if self.func else self.value
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.func() if self.func else self.value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '%s_bucket{le="%g"}' % (self.name, bound), total
+        yield '%s_bucket{le="+Inf"}' % self.name, self.count
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+class Metrics:
+    """Prometheus text exposition of plain in-process metrics.
+
+    Metrics are updated without locks and are meant to be touched from the
+    event loop thread only, worker threads hand their timings back to it.
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, metric):
+        self.items.append(metric)
+        return metric
+
+    def counter(self, name, help, func=None):
+        return self.add(Counter(name, help, func))
+
+    def gauge(self, name, help, func=None):
+        return self.add(Gauge(name, help, func))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.items:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, repr(float(value))))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import asyncio
+import concurrent.futures
+import logging
+import re
+from collections import OrderedDict
+from pathlib import Path
+from vosk import Model
+try:
+    from vosk import MODEL_DIRS
+except ImportError:
+    # Older vosk, same search path as Model(lang=...)
+    MODEL_DIRS = [os.getenv('VOSK_MODEL_PATH'), Path('/usr/share/vosk'),
+                  Path.home() / 'AppData/Local/vosk', Path.home() / '.cache/vosk']
+
+def model_key(name):
+    """Normalize a client supplied model name into a registry key."""
+    if name.startswith('lang:'):
+        return name
+    return os.path.realpath(name)
+
+def load_model(key):
+    if key.startswith('lang:'):
+        return Model(lang=key[len('lang:'):])
+    return Model(key)
+
+def model_dir(key):
+    """Directory a model is loaded from, None if not on disk yet.
+
+    For lang: keys this is the directory Model(lang=...) picks from the vosk
+    model cache.
+    """
+    if not key.startswith('lang:'):
+        return key if os.path.isdir(key) else None
+    pattern = re.compile(r'vosk-model(-small)?-%s' % re.escape(key[len('lang:'):]))
+    for directory in MODEL_DIRS:
+        if directory is None or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if pattern.match(name):
+                return os.path.join(directory, name)
+    return None
+
+def model_size(key):
+    """Bytes on disk of a model directory, used as its memory estimate."""
+    path = model_dir(key)
+    if path is None:
+        return 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+class ModelEntry:
+
+    def __init__(self, key, model, size, generation):
+        self.key = key
+        self.model = model
+        self.size = size
+        self.generation = generation
+        self.refs = 0
+        self.pinned = False
+        self.retired = False
+
+    @property
+    def ident(self):
+        return '%s#%d' % (self.key, self.generation)
+
+class ModelRegistry:
+    """Process wide cache of loaded Vosk models.
+
+    Models are loaded on a private executor so the event loop never blocks,
+    shared between sessions with a reference count and evicted in LRU order
+    once the estimated size of the idle models exceeds the memory budget.
+    All methods must be called from the event loop thread.
+    """
+
+    def __init__(self, budget_mb=0, loaders=1):
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.generation = 0
+        self.listeners = []
+        self.pool = concurrent.futures.ThreadPoolExecutor(loaders)
+
+    def add(self, key, model, pinned=False):
+        """Register an already loaded model, e.g. the default one."""
+        self.generation += 1
+        entry = ModelEntry(key, model, model_size(key), self.generation)
+        entry.pinned = pinned
+        self.entries[key] = entry
+        return entry
+
+    async def acquire(self, key):
+        """Return the entry for key, loading it in the background if needed."""
+        entry = self.entries.get(key)
+        if entry is None:
+            task = self.loading.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._load(key))
+                self.loading[key] = task
+                task.add_done_callback(lambda t: self.loading.pop(key, None))
+            entry = await asyncio.shield(task)
+            entry = self.entries.setdefault(key, entry)
+        self.entries.move_to_end(key)
+        entry.refs += 1
+        self._evict()
+        return entry
+
+    async def _load(self, key):
+        loop = asyncio.get_running_loop()
+        logging.info('Loading model %s', key)
+        model = await loop.run_in_executor(self.pool, load_model, key)
+        return self.add(key, model)
+
+    async def reload(self, key, warm=None):
+        """Load key again and hand it to new sessions once it is ready.
+
+        warm(entry) runs on the loader executor before the switch, e.g. to
+        compile grammars. Sessions holding the old entry keep using it and it
+        is freed when the last of them releases it.
+        """
+        loop = asyncio.get_running_loop()
+        logging.info('Reloading model %s', key)
+        model = await loop.run_in_executor(self.pool, load_model, key)
+        self.generation += 1
+        entry = ModelEntry(key, model, model_size(key), self.generation)
+        if warm:
+            await loop.run_in_executor(self.pool, warm, entry)
+        old = self.entries.get(key)
+        if old is not None:
+            entry.pinned = old.pinned
+            self.retire(old)
+        self.entries[key] = entry
+        self._evict()
+        return entry
+
+    def retire(self, entry):
+        entry.retired = True
+        if entry.refs == 0:
+            logging.info('Freeing retired model %s', entry.ident)
+            self._dropped(entry)
+
+    def release(self, entry):
+        entry.refs -= 1
+        if entry.refs == 0 and entry.retired:
+            logging.info('Freeing retired model %s', entry.ident)
+            self._dropped(entry)
+        self._evict()
+
+    def _evict(self):
+        if not self.budget:
+            return
+        total = sum(entry.size for entry in self.entries.values())
+        for key, entry in list(self.entries.items()):
+            if total <= self.budget:
+                break
+            if entry.refs or entry.pinned:
+                continue
+            logging.info('Evicting model %s (%d MB)', key, entry.size // (1024 * 1024))
+            del self.entries[key]
+            total -= entry.size
+            self._dropped(entry)
+
+    def _dropped(self, entry):
+        for listener in self.listeners:
+            listener(entry)
+        entry.model = None
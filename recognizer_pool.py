@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import time
+import hashlib
+import threading
+from vosk import KaldiRecognizer
+try:
+    from vosk import EndpointerMode
+except ImportError:
+    EndpointerMode = None
+
+def grammar_hash(grammar):
+    if not grammar:
+        return None
+    return hashlib.sha1(grammar.encode('utf-8')).hexdigest()
+
+def check_endpointer(endpointer):
+    """Raise ValueError unless set_endpointer can apply these settings."""
+    mode, delays = endpointer
+    if EndpointerMode is None:
+        raise ValueError('This vosk version does not support endpointer settings')
+    if mode is not None and (not isinstance(mode, str) or mode.upper() not in EndpointerMode.__members__):
+        raise ValueError('Unknown endpointer mode %s' % mode)
+
+def set_endpointer(rec, endpointer):
+    """Apply (mode name, (start_max, end, max) delays), either may be None."""
+    mode, delays = endpointer
+    if EndpointerMode is None:
+        raise ValueError('This vosk version does not support endpointer settings')
+    if mode:
+        rec.SetEndpointerMode(EndpointerMode[mode.upper()])
+    if delays:
+        rec.SetEndpointerDelays(*delays)
+
+def new_recognizer(model, sample_rate, grammar=None, show_words=True, max_alternatives=0, spk_model=None,
+                   endpointer=None):
+    """Build a recognizer, grammar is the JSON phrase list or None."""
+    if grammar:
+        rec = KaldiRecognizer(model, sample_rate, grammar)
+    else:
+        rec = KaldiRecognizer(model, sample_rate)
+    rec.SetWords(show_words)
+    rec.SetMaxAlternatives(max_alternatives)
+    if spk_model:
+        rec.SetSpkModel(spk_model)
+    if endpointer:
+        set_endpointer(rec, endpointer)
+    return rec
+
+class RecognizerPool:
+    """Warm KaldiRecognizer instances reused across connections.
+
+    Recognizers are keyed by everything that is fixed at construction time.
+    checkout() and checkin() may block (construction, Reset()) and are meant
+    to run on the decode executor, the pool itself is guarded by a lock.
+    """
+
+    def __init__(self, max_size=32, max_idle=300.0):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def checkout(self, entry, sample_rate, grammar=None, show_words=True, max_alternatives=0, spk_model=None,
+                 endpointer=None):
+        key = (entry.ident, sample_rate, grammar_hash(grammar),
+               show_words, max_alternatives, spk_model is not None, endpointer)
+        with self.lock:
+            self._expire(time.monotonic())
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][0] == key:
+                    rec = self.idle.pop(i)[1]
+                    self.hits += 1
+                    return key, rec
+            self.misses += 1
+        rec = new_recognizer(entry.model, sample_rate, grammar, show_words, max_alternatives, spk_model,
+                             endpointer)
+        return key, rec
+
+    def checkin(self, key, rec):
+        rec.Reset()
+        now = time.monotonic()
+        with self.lock:
+            self.idle.append((key, rec, now))
+            self._expire(now)
+
+    def discard(self, ident):
+        """Drop idle recognizers of a model that left the registry."""
+        with self.lock:
+            self.idle = [item for item in self.idle if item[0][0] != ident]
+
+    def stats(self):
+        return {'idle': len(self.idle), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _expire(self, now):
+        while self.idle and (len(self.idle) > self.max_size or now - self.idle[0][2] > self.max_idle):
+            self.idle.pop(0)
+            self.evictions += 1
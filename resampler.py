@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import math
+import time
+import numpy as np
+
+FORMATS = {'int16': ('<i2', 2), 'float32': ('<f4', 4)}
+
+class StreamResampler:
+    """Polyphase resampler for streamed PCM with filter state across chunks.
+
+    Input is int16 or float32 little endian PCM at in_rate, output is int16
+    PCM at out_rate. Every output sample is computed with the same sequence
+    of operations no matter how the input is split into chunks, so the
+    stream is bit identical to resampling the whole signal at once. The
+    lowpass is a Kaiser windowed sinc like scipy.signal.resample_poly uses.
+    """
+
+    def __init__(self, in_rate, out_rate, fmt='int16', half_len=10, beta=5.0):
+        if fmt not in FORMATS:
+            raise ValueError('Unsupported sample format %s' % fmt)
+        self.dtype, self.width = FORMATS[fmt]
+        self.scale = 32768.0 if fmt == 'float32' else 1.0
+        in_rate, out_rate = int(in_rate), int(out_rate)
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.in_rate = in_rate
+        self.remainder = b''
+        self.n_in = 0
+        self.n_out = 0
+        self.cost = 0.0
+        self.phases = None
+        if self.up == self.down == 1:
+            return
+        n = 2 * half_len * max(self.up, self.down) + 1
+        fc = 0.5 / max(self.up, self.down)
+        t = np.arange(n) - (n - 1) / 2.0
+        h = 2 * fc * np.sinc(2 * fc * t) * np.kaiser(n, beta)
+        h *= self.up / h.sum()
+        taps = -(-n // self.up)
+        phases = np.zeros((self.up, taps))
+        for p in range(self.up):
+            row = h[p::self.up]
+            phases[p, :len(row)] = row
+        self.phases = phases
+        self.history = np.zeros(taps - 1)
+
+    @property
+    def seconds(self):
+        return self.n_in / self.in_rate
+
+    def process(self, data):
+        """Resample a chunk of PCM bytes, return int16 PCM bytes."""
+        start = time.perf_counter()
+        if self.remainder:
+            data = self.remainder + data
+        usable = len(data) - len(data) % self.width
+        self.remainder = data[usable:]
+        x = np.frombuffer(data, dtype=self.dtype, count=usable // self.width).astype(np.float64)
+        if self.scale != 1.0:
+            x *= self.scale
+        if self.phases is None:
+            self.n_in += len(x)
+            y = x
+        else:
+            y = self._filter(x)
+        out = np.clip(np.rint(y), -32768, 32767).astype('<i2').tobytes()
+        self.cost += time.perf_counter() - start
+        return out
+
+    def _filter(self, x):
+        taps = self.phases.shape[1]
+        xs = np.concatenate((self.history, x))
+        base = self.n_in - (taps - 1)
+        total = self.n_in + len(x)
+
+        # Output n needs inputs up to index n * down // up
+        end = (total * self.up - 1) // self.down + 1 if total else 0
+        ns = np.arange(self.n_out, end, dtype=np.int64)
+        pos = ns * self.down
+        newest = pos // self.up - base
+        phase = pos % self.up
+
+        y = np.zeros(len(ns))
+        for k in range(taps):
+            y += self.phases[phase, k] * xs[newest - k]
+
+        if taps > 1:
+            self.history = xs[len(xs) - (taps - 1):]
+        self.n_in = total
+        self.n_out = end
+        return y
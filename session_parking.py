@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import secrets
+
+def new_token():
+    return secrets.token_urlsafe(16)
+
+class SessionParking:
+    """Recognizer state of dropped connections, kept for a grace period.
+
+    A client that reconnects with its session token before the grace period
+    runs out gets the parked state back and continues mid-utterance. At most
+    max_size sessions are parked, when another one arrives the oldest is
+    released first. release(state) is called for every state that expires
+    or is pushed out. Must be used from the event loop thread.
+    """
+
+    def __init__(self, grace, max_size, release):
+        self.grace = grace
+        self.max_size = max_size
+        self.release = release
+        self.parked = collections.OrderedDict()
+        self.resumed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.parked)
+
+    def park(self, token, state):
+        if self.grace <= 0 or self.max_size <= 0:
+            self.release(state)
+            return
+        timer = asyncio.get_running_loop().call_later(self.grace, self._expire, token)
+        self.parked[token] = (state, timer)
+        while len(self.parked) > self.max_size:
+            _, (old, timer) = self.parked.popitem(last=False)
+            timer.cancel()
+            self.expired += 1
+            self.release(old)
+
+    def claim(self, token):
+        """Take the state parked under token, None if unknown or expired."""
+        item = self.parked.pop(token, None)
+        if item is None:
+            return None
+        state, timer = item
+        timer.cancel()
+        self.resumed += 1
+        return state
+
+    def _expire(self, token):
+        item = self.parked.pop(token, None)
+        if item is not None:
+            self.expired += 1
+            self.release(item[0])
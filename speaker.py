@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import json
+
+# A single word grammar keeps the search of the extra decode cheap, the
+# x-vector only needs the features and the speech/silence split of the
+# utterance. The acoustic model still runs over the audio a second time:
+# vosk only computes x-vectors inside a recognizer, and attaching the speaker
+# model to the decoding one would put the x-vector back in front of the final
+# result
+SPK_GRAMMAR = '["[unk]"]'
+
+def extract_xvector(recognizers, entry, sample_rate, audio, spk_model):
+    """Compute the speaker vector of one utterance, return (vector, frames)."""
+    key, rec = recognizers.checkout(entry, sample_rate, SPK_GRAMMAR, False, 0, spk_model)
+    try:
+        rec.AcceptWaveform(audio)
+        result = json.loads(rec.FinalResult())
+    finally:
+        recognizers.checkin(key, rec)
+    return result.get('spk'), result.get('spk_frames', 0)
+
+class RunningMean:
+    """Frame weighted mean of the speaker vectors seen so far."""
+
+    def __init__(self):
+        self.mean = None
+        self.frames = 0
+
+    def add(self, vector, frames):
+        if not vector or frames <= 0:
+            return
+        if self.mean is None:
+            self.mean = list(vector)
+        else:
+            w = frames / (self.frames + frames)
+            self.mean = [m + (v - m) * w for m, v in zip(self.mean, vector)]
+        self.frames += frames
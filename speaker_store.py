@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import numpy as np
+
+class SpeakerStore:
+    """Enrolled voiceprints in a memory mapped float32 matrix.
+
+    <path>.f32 holds one L2 normalized x-vector per row and <path>.json the
+    speaker id of every row (null for free rows). Adding writes a single row
+    into a free slot, removing clears one, and the matrix only grows by
+    doubling when it is full. Identification is one matrix-vector product
+    over the used rows, so cosine scores against all speakers come out of a
+    single BLAS call.
+
+    Several processes can share a store. Writers hold an exclusive lock on
+    <path>.lock and start from the index on disk, readers call refresh() to
+    pick up an index another process saved.
+    """
+
+    def __init__(self, path, dim=128, capacity=1024):
+        self.path = path
+        self.index = path + '.json'
+        self.dim = dim
+        self.ids = [None] * capacity
+        self.matrix = None
+        self.mtime = None
+        self.rows = {}
+        self.active = np.zeros(capacity, dtype=bool)
+        self.refresh()
+
+    def refresh(self):
+        """Reload the index if it changed on disk, return True if it did."""
+        try:
+            if os.stat(self.index).st_mtime_ns == self.mtime:
+                return False
+            f = open(self.index, encoding='utf-8')
+        except FileNotFoundError:
+            return False
+        with f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            meta = json.load(f)
+        self.mtime = mtime
+        self.dim = meta['dim']
+        self.ids = meta['ids']
+        if self.matrix is None or self.matrix.shape != (len(self.ids), self.dim):
+            self._map(len(self.ids))
+        self.rows = {sid: row for row, sid in enumerate(self.ids) if sid is not None}
+        self.active = np.array([sid is not None for sid in self.ids], dtype=bool)
+        return True
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.refresh()
+            yield
+
+    def _map(self, capacity):
+        data = self.path + '.f32'
+        size = capacity * self.dim * 4
+        with open(data, 'ab') as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.matrix = np.memmap(data, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def _save(self):
+        with open(self.index + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'capacity': len(self.ids), 'ids': self.ids}, f, ensure_ascii=False)
+        os.replace(self.index + '.tmp', self.index)
+        self.mtime = os.stat(self.index).st_mtime_ns
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _normalize(self, vector):
+        v = np.asarray(vector, dtype=np.float32)
+        if v.shape != (self.dim,):
+            raise ValueError('Expected a %d dimensional vector' % self.dim)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def add(self, speaker_id, vector):
+        """Enroll or replace the voiceprint of speaker_id."""
+        with self._locked():
+            if self.matrix is None:
+                # New store, its dimension is the one of the first voiceprint
+                self.dim = len(vector)
+                self._map(len(self.ids))
+            v = self._normalize(vector)
+            row = self.rows.get(speaker_id)
+            if row is None:
+                if len(self.rows) == len(self.ids):
+                    self._grow()
+                row = self.ids.index(None)
+            self.matrix[row] = v
+            self.matrix.flush()
+            self.ids[row] = speaker_id
+            self.rows[speaker_id] = row
+            self.active[row] = True
+            self._save()
+
+    def remove(self, speaker_id):
+        with self._locked():
+            row = self.rows.pop(speaker_id, None)
+            if row is None:
+                return False
+            self.matrix[row] = 0
+            self.matrix.flush()
+            self.ids[row] = None
+            self.active[row] = False
+            self._save()
+            return True
+
+    def _grow(self):
+        capacity = 2 * len(self.ids)
+        self.matrix.flush()
+        del self.matrix
+        self._map(capacity)
+        self.ids.extend([None] * (capacity - len(self.ids)))
+        self.active = np.concatenate((self.active, np.zeros(capacity - len(self.active), dtype=bool)))
+
+    def identify(self, vector):
+        """Return (speaker id, cosine score) of the closest voiceprint, or (None, None)."""
+        if not self.rows:
+            return None, None
+        scores = self.matrix @ self._normalize(vector)
+        scores[~self.active] = -np.inf
+        best = int(np.argmax(scores))
+        return self.ids[best], float(scores[best])
+
+def voiceprint(model_path, spk_model_path, wav_paths, block_seconds=0.5):
+    """Frame weighted mean speaker vector of the utterances in WAV files."""
+    from vosk import SpkModel
+    from asr_batch import wav_data
+    from model_registry import load_model
+    from model_registry import model_key
+    from recognizer_pool import new_recognizer
+    from speaker import SPK_GRAMMAR, RunningMean
+
+    model = load_model(model_key(model_path))
+    spk_model = SpkModel(spk_model_path)
+    mean = RunningMean()
+    for path in wav_paths:
+        with open(path, 'rb') as f:
+            mm, rate, data = wav_data(f)
+            try:
+                rec = new_recognizer(model, rate, SPK_GRAMMAR, False, 0, spk_model)
+                block = int(rate * block_seconds) * 2
+                results = []
+                for offset in range(0, len(data), block):
+                    if rec.AcceptWaveform(bytes(data[offset:offset + block])):
+                        results.append(json.loads(rec.Result()))
+                results.append(json.loads(rec.FinalResult()))
+            finally:
+                data.release()
+                mm.close()
+        for result in results:
+            mean.add(result.get('spk'), result.get('spk_frames', 0))
+    return mean
+
+def main():
+    # Enrollment is an operator task, the server only reads the store and
+    # picks up changes while it runs
+    parser = argparse.ArgumentParser(description="List, enroll and remove the speakers of a VOSK_SPK_STORE")
+    parser.add_argument('path', help='VOSK_SPK_STORE path prefix')
+    sub = parser.add_subparsers(dest='command')
+    enroll = sub.add_parser('enroll', help='enroll a speaker from 16-bit mono WAV recordings')
+    enroll.add_argument('speaker')
+    enroll.add_argument('wavs', nargs='+')
+    enroll.add_argument('-m', '--model', default=os.environ.get('VOSK_MODEL_PATH', 'model'),
+                        help='model directory or lang:<code>')
+    enroll.add_argument('-s', '--spk-model', default=os.environ.get('VOSK_SPK_MODEL_PATH'),
+                        help='speaker model directory, default VOSK_SPK_MODEL_PATH')
+    remove = sub.add_parser('remove', help='remove a speaker')
+    remove.add_argument('speaker')
+    args = parser.parse_args()
+
+    if args.command == 'enroll' and not args.spk_model:
+        parser.error('enroll needs --spk-model or VOSK_SPK_MODEL_PATH')
+
+    store = SpeakerStore(args.path)
+    if args.command == 'enroll':
+        mean = voiceprint(args.model, args.spk_model, args.wavs)
+        if mean.mean is None:
+            raise SystemExit('No speech found in %s' % ' '.join(args.wavs))
+        store.add(args.speaker, mean.mean)
+        print('enrolled %s from %d frames' % (args.speaker, mean.frames))
+    elif args.command == 'remove':
+        print('removed' if store.remove(args.speaker) else 'not enrolled')
+    else:
+        for sid in sorted(store.rows):
+            print(sid)
+
+if __name__ == '__main__':
+    main()
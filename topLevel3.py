@@ -6,6 +6,7 @@ import websockets
 import json
 import logging
 import re
+from asr_client import AudioQueue, stream_audio, finish
 
 is_speaking = False
 
@@ -39,15 +40,13 @@ async def run_test():
                    #websockets.connect(args.tts_uri) as websocket_tts:
             await websocket_asr.send(json.dumps({"config": {"sample_rate": device.samplerate}}))
 
-            while True:
-                data = await audio_queue.get()
-                await websocket_asr.send(data)
-                result = await websocket_asr.recv()
-                result_json = json.loads(result)
-                
+            # Audio keeps streaming to the ASR server while a result is
+            # being answered, results are handled in order as they arrive
+            async def handle_result(result_json):
                 if 'result' in result_json:
                     recognized_text = result_json['result']
                     print("Final Recognized Text:", recognized_text)
+                    audio_queue.check_dropped()
                     
                     # Send recognized text to LLM WebSocket
                     await websocket_llm.send(recognized_text)
@@ -60,12 +59,12 @@ async def run_test():
                         #await send_to_tts(websocket_tts, sentence)
                         print(sentence)
 
-                if 'final' in result_json and result_json['final']:
-                    break
+                return 'final' in result_json and result_json['final']
+
+            await stream_audio(websocket_asr, audio_queue, handle_result)
 
-            await websocket_asr.send('{"eof" : 1}')
             print("Final result:")
-            final_result = await websocket_asr.recv()
+            final_result = await finish(websocket_asr)
             print(final_result)
 
 async def main():
@@ -92,9 +91,10 @@ async def main():
     parser.add_argument('-i', '--device', type=int_or_str,
                         help='input device (numeric ID or substring)')
     parser.add_argument('-r', '--samplerate', type=int, help='sampling rate', default=16000)
+    parser.add_argument('-q', '--queue', type=int, help='audio blocks buffered for the ASR server', default=40)
     args = parser.parse_args(remaining)
     loop = asyncio.get_running_loop()
-    audio_queue = asyncio.Queue()
+    audio_queue = AudioQueue(args.queue)
 
     logging.basicConfig(level=logging.INFO)
     await run_test()
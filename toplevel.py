@@ -6,6 +6,9 @@ import websockets
 import json
 import logging
 import re
+import time
+import uuid
+from asr_client import AudioQueue, stream_audio, finish
 
 is_speaking = False
 
@@ -32,25 +35,136 @@ async def send_to_tts(websocket_tts, text):
     is_speaking = False
     print("TTS completed")
 
-async def process_llm_response(websocket_llm, websocket_tts, recognized_text):
-    """Send recognized text to LLM WebSocket and process the response."""
+async def speak_llm_response(websocket_tts, llm_response):
+    """Split LLM response into sentences and send them to TTS."""
+    #sentences = re.split(r'(?<=[.!?。])\s+', llm_response)
+    sentences = re.split(r'(?<=[,.，。？！])\s*|\n', llm_response)
+    print(f"Split sentences: {sentences}")
+    for sentence in sentences:
+        if sentence:  # Ensure not to send empty strings
+            await send_to_tts(websocket_tts, sentence)
+
+async def process_llm_response(websocket_llm, websocket_tts, recognized_text, session=None):
+    """Send recognized text to LLM WebSocket and process the response.
+
+    With a session the request names the conversation history to use
+    (llm_server3.py), otherwise the text is sent as is.
+    """
     try:
         print(f"Sending to LLM: {recognized_text}")
-        await websocket_llm.send(recognized_text)
+        if session:
+            await websocket_llm.send(json.dumps({"text": recognized_text, "session": session}, ensure_ascii=False))
+        else:
+            await websocket_llm.send(recognized_text)
         llm_response = await websocket_llm.recv()
         print("LLM Response:", llm_response)
-
-        # Split LLM response into sentences and send to TTS
-        #sentences = re.split(r'(?<=[.!?。])\s+', llm_response)
-        sentences = re.split(r'(?<=[,.，。？！])\s*|\n', llm_response)
-        print(f"Split sentences: {sentences}")
-        for sentence in sentences:
-            if sentence:  # Ensure not to send empty strings
-                await send_to_tts(websocket_tts, sentence)
+        await speak_llm_response(websocket_tts, llm_response)
     except websockets.exceptions.ConnectionClosedError as e:
         print(f"LLM WebSocket connection closed: {e}")
         raise e
 
+def normalize(text):
+    """Text as compared between a speculative request and the final result."""
+    return re.sub(r'[\s、。，,.!?！？]', '', text)
+
+class Speculator:
+    """Send the LLM request once the partial result stops changing.
+
+    The request goes out on its own LLM connection when the partial result
+    has been the same for stable_seconds. If the final result matches it
+    the answer is used, otherwise the request is cancelled by closing that
+    connection and the final result is sent as usual. The request is a
+    streamed one of the conversation's session with "commit" : false, which
+    llm_server3.py keeps out of the history until commit() is sent after a
+    hit and cancels when the connection closes, so a discarded guess is
+    neither remembered nor holds up the request sent instead.
+    """
+
+    def __init__(self, llm_uri, stable_seconds, session):
+        self.llm_uri = llm_uri
+        self.stable_seconds = stable_seconds
+        self.session = session
+        self.partial = ''
+        self.changed = 0.0
+        self.text = None
+        self.task = None
+        self.started = 0.0
+        self.answered = None
+        self.finals = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+
+    async def ask(self, text):
+        sentences = []
+        async with websockets.connect(self.llm_uri) as websocket_llm:
+            await websocket_llm.send(json.dumps({"text": text, "stream": True, "session": self.session,
+                                                 "commit": False}, ensure_ascii=False))
+            async for message in websocket_llm:
+                frame = json.loads(message)
+                if frame.get("end"):
+                    break
+                sentences.append(frame["text"])
+        self.answered = time.monotonic()
+        return "\n".join(sentences)
+
+    async def commit(self, websocket_llm):
+        """Add the turn of the speculative answer used to the history."""
+        await websocket_llm.send(json.dumps({"session": self.session, "commit": True}))
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+            self.text = None
+
+    def partial_result(self, partial):
+        now = time.monotonic()
+        if partial != self.partial:
+            self.partial = partial
+            self.changed = now
+            # The speaker went on, the request in flight is no longer useful
+            if self.text is not None and normalize(partial) != normalize(self.text):
+                self.cancel()
+            return
+        if normalize(partial) and self.task is None and now - self.changed >= self.stable_seconds:
+            print(f"Speculative LLM request: {partial}")
+            self.text = partial
+            self.started = now
+            self.answered = None
+            self.task = asyncio.ensure_future(self.ask(partial))
+
+    async def final_result(self, recognized_text):
+        """Return the speculative answer for recognized_text, or None."""
+        self.finals += 1
+        task, text = self.task, self.text
+        self.task = None
+        self.text = None
+        self.partial = ''
+        if task is None:
+            return None
+        if normalize(text) != normalize(recognized_text):
+            task.cancel()
+            self.misses += 1
+            return None
+        arrived = time.monotonic()
+        try:
+            llm_response = await task
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            print(f"Speculative LLM request failed: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Without speculation the answer would have been ready one request
+        # duration after the final result
+        self.saved += min(arrived, self.answered) - self.started
+        return llm_response
+
+    def stats(self):
+        return 'speculation hits %d, misses %d, finals %d, hit rate %.0f%%, %.0f ms saved per hit' % (
+            self.hits, self.misses, self.finals, 100.0 * self.hits / max(1, self.finals),
+            1000.0 * self.saved / max(1, self.hits))
+
 async def run_test():
     global is_speaking
 
@@ -65,36 +179,60 @@ async def run_test():
                 print(f"Connected to TTS server at {args.tts_uri}")
                 
                 await websocket_asr.send(json.dumps({"config": {"sample_rate": device.samplerate}}))
+                # Speculative and regular requests share one conversation on
+                # the LLM server
+                session = uuid.uuid4().hex if args.speculate > 0 else None
+                speculator = Speculator(args.llm_uri, args.speculate / 1000.0, session) if session else None
+
+                # Audio keeps streaming to the ASR server while a result is
+                # being answered, results are handled in order as they arrive
+                async def handle_result(result_json):
+                    nonlocal websocket_llm
+
+                    if speculator:
+                        if 'partial' in result_json:
+                            speculator.partial_result(result_json['partial'])
+                        elif 'text' in result_json and 'result' not in result_json:
+                            speculator.cancel()
 
-                while True:
-                    data = await audio_queue.get()
-                    await websocket_asr.send(data)
-                    result = await websocket_asr.recv()
-                    result_json = json.loads(result)
-                    
                     if 'result' in result_json:
                         recognized_text_list = result_json['result']
                         recognized_text = ' '.join([word_info['word'] for word_info in recognized_text_list])
                         print("Final Recognized Text:", recognized_text)
+                        audio_queue.check_dropped()
                         
                         # Ensure recognized_text is a string
                         if not isinstance(recognized_text, str):
                             recognized_text = str(recognized_text)
                         
-                        # Process LLM response and handle errors
-                        try:
-                            await process_llm_response(websocket_llm, websocket_tts, recognized_text)
-                        except websockets.exceptions.ConnectionClosedError as e:
-                            print(f"Retrying LLM connection due to error: {e}")
-                            async with websockets.connect(args.llm_uri) as websocket_llm:
-                                await process_llm_response(websocket_llm, websocket_tts, recognized_text)
-
-                    if 'final' in result_json and result_json['final']:
-                        break
-
-                await websocket_asr.send('{"eof" : 1}')
+                        llm_response = await speculator.final_result(recognized_text) if speculator else None
+                        if llm_response is not None:
+                            print("LLM Response (speculative):", llm_response)
+                            try:
+                                await speculator.commit(websocket_llm)
+                            except websockets.exceptions.ConnectionClosedError as e:
+                                print(f"Retrying LLM connection due to error: {e}")
+                                async with websockets.connect(args.llm_uri) as websocket_llm:
+                                    await speculator.commit(websocket_llm)
+                            await speak_llm_response(websocket_tts, llm_response)
+                        else:
+                            # Process LLM response and handle errors
+                            try:
+                                await process_llm_response(websocket_llm, websocket_tts, recognized_text, session)
+                            except websockets.exceptions.ConnectionClosedError as e:
+                                print(f"Retrying LLM connection due to error: {e}")
+                                async with websockets.connect(args.llm_uri) as websocket_llm:
+                                    await process_llm_response(websocket_llm, websocket_tts, recognized_text,
+                                                               session)
+                        if speculator:
+                            logging.info(speculator.stats())
+
+                    return 'final' in result_json and result_json['final']
+
+                await stream_audio(websocket_asr, audio_queue, handle_result)
+
                 print("Final result:")
-                final_result = await websocket_asr.recv()
+                final_result = await finish(websocket_asr)
                 print(final_result)
         except websockets.exceptions.ConnectionClosedError as e:
             print(f"WebSocket connection closed: {e}")
@@ -123,9 +261,13 @@ async def main():
     parser.add_argument('-i', '--device', type=int_or_str,
                         help='input device (numeric ID or substring)')
     parser.add_argument('-r', '--samplerate', type=int, help='sampling rate', default=16000)
+    parser.add_argument('-s', '--speculate', type=int, metavar='MS', default=0,
+                        help='send the LLM request once the partial result is stable for MS milliseconds '
+                        '(0 = off, needs llm_server3.py)')
+    parser.add_argument('-q', '--queue', type=int, help='audio blocks buffered for the ASR server', default=40)
     args = parser.parse_args(remaining)
     loop = asyncio.get_running_loop()
-    audio_queue = asyncio.Queue()
+    audio_queue = AudioQueue(args.queue)
 
     logging.basicConfig(level=logging.INFO)
     await run_test()
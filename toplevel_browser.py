@@ -10,6 +10,7 @@ from flask import Flask, render_template
 from gevent.pywsgi import WSGIServer
 from gevent import monkey
 from multiprocessing import Process
+from asr_client import AudioQueue, stream_audio, finish
 
 # Apply monkey patch
 monkey.patch_all()
@@ -98,16 +99,16 @@ async def run_test():
                 
                 await websocket_asr.send(json.dumps({"config": {"sample_rate": device.samplerate}}))
 
-                while True:
-                    data = await audio_queue.get()
-                    await websocket_asr.send(data)
-                    result = await websocket_asr.recv()
-                    result_json = json.loads(result)
-                    
+                # Audio keeps streaming to the ASR server while a result is
+                # being answered, results are handled in order as they arrive
+                async def handle_result(result_json):
+                    nonlocal websocket_llm
+
                     if 'result' in result_json:
                         recognized_text_list = result_json['result']
                         recognized_text = ' '.join([word_info['word'] for word_info in recognized_text_list])
                         print("Final Recognized Text:", recognized_text)
+                        audio_queue.check_dropped()
                         
                         # Ensure recognized_text is a string
                         if not isinstance(recognized_text, str):
@@ -127,12 +128,12 @@ async def run_test():
                                 async with websockets.connect(args.llm_uri) as websocket_llm:
                                     await process_llm_response(websocket_llm, websocket_tts, recognized_text)
 
-                    if 'final' in result_json and result_json['final']:
-                        break
+                    return 'final' in result_json and result_json['final']
+
+                await stream_audio(websocket_asr, audio_queue, handle_result)
 
-                await websocket_asr.send('{"eof" : 1}')
                 print("Final result:")
-                final_result = await websocket_asr.recv()
+                final_result = await finish(websocket_asr)
                 print(final_result)
         except websockets.exceptions.ConnectionClosedError as e:
             print(f"WebSocket connection closed: {e}")
@@ -141,7 +142,7 @@ def start_asyncio_loop():
     global loop, audio_queue
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    audio_queue = asyncio.Queue()
+    audio_queue = AudioQueue(args.queue)
     loop.run_until_complete(main_async())
 
 async def main_async():
@@ -169,6 +170,7 @@ def main():
     parser.add_argument('-i', '--device', type=int_or_str,
                         help='input device (numeric ID or substring)')
     parser.add_argument('-r', '--samplerate', type=int, help='sampling rate', default=16000)
+    parser.add_argument('-q', '--queue', type=int, help='audio blocks buffered for the ASR server', default=40)
     args = parser.parse_args(remaining)
     
     # Start Flask server
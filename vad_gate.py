@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import collections
+
+class VadGate:
+    """Server side voice activity gate in front of the recognizer.
+
+    Audio is cut into webrtcvad frames. Silence before speech is kept in a
+    short pre-roll buffer and dropped otherwise, speech plus the hangover
+    after it is passed through, and the end of speech is reported once the
+    hangover runs out so the caller can finalize the utterance.
+    """
+
+    RATES = (8000, 16000, 32000, 48000)
+
+    def __init__(self, sample_rate, mode=3, frame_ms=30, preroll_ms=300, hangover_ms=600):
+        if int(sample_rate) not in self.RATES:
+            raise ValueError('VAD does not support sample rate %s' % sample_rate)
+        try:
+            import webrtcvad
+        except ImportError:
+            raise ValueError('VAD needs the webrtcvad package (pip install webrtcvad)')
+        self.sample_rate = int(sample_rate)
+        self.vad = webrtcvad.Vad(int(mode))
+        self.frame_ms = frame_ms
+        self.frame_bytes = self.sample_rate * frame_ms // 1000 * 2
+        self.preroll = collections.deque(maxlen=max(1, preroll_ms // frame_ms))
+        self.hangover = max(1, hangover_ms // frame_ms)
+        self.pending = bytearray()
+        self.speaking = False
+        self.silent = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, sample_rate, conf):
+        """Build a gate from the 'vad' config value, a mode number or a dict."""
+        if isinstance(conf, dict):
+            return cls(sample_rate, conf.get('mode', 3),
+                       preroll_ms=int(conf.get('preroll_ms', 300)),
+                       hangover_ms=int(conf.get('hangover_ms', 600)))
+        return cls(sample_rate, int(conf))
+
+    @property
+    def dropped_seconds(self):
+        return self.dropped * self.frame_ms / 1000.0
+
+    def process(self, data):
+        """Feed audio, return (voiced_bytes, end_of_speech)."""
+        self.pending += data
+        fb = self.frame_bytes
+        out = bytearray()
+        end = False
+        pos = 0
+        while len(self.pending) - pos >= fb:
+            frame = bytes(self.pending[pos:pos + fb])
+            pos += fb
+            if self.vad.is_speech(frame, self.sample_rate):
+                if not self.speaking:
+                    self.speaking = True
+                    for f in self.preroll:
+                        out += f
+                    self.preroll.clear()
+                self.silent = 0
+                out += frame
+            elif self.speaking:
+                out += frame
+                self.silent += 1
+                if self.silent >= self.hangover:
+                    # Leave the rest for the next call so one result never
+                    # spans two utterances
+                    self.speaking = False
+                    self.silent = 0
+                    end = True
+                    break
+            else:
+                if len(self.preroll) == self.preroll.maxlen:
+                    self.dropped += 1
+                self.preroll.append(frame)
+        del self.pending[:pos]
+        return bytes(out), end